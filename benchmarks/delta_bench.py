@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+#                 __
+#    ____ _____  |  | _____
+#   /    \\__  \ |  | \__  \
+#  |   |  \/ __ \|  |__/ __ \_
+#  |___|  (____  /____(____  /
+#       \/     \/          \/
+#
+# Copyright (C) 2021, 2022 Blake Lee
+#
+# This file is part of nala
+#
+# nala is program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# nala is program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with nala.  If not, see <https://www.gnu.org/licenses/>.
+"""Measure the bytes debdeltas save against the CPU debpatch spends rebuilding.
+
+Each pair of old and new packages gets a delta from debdelta. The new package is then
+rebuilt from the old one with debpatch, timed, and checked against the real one.
+
+With --serve the deltas are kept and served as a stand-in for a delta server. Point
+Nala::Download::Delta-Server at it, with the old versions installed, to try an upgrade.
+The directories nala asks for are ignored, deltas are found by their file name.
+
+Needs the debdelta package. Run it from a checkout with
+python3 benchmarks/delta_bench.py OLD.deb NEW.deb [OLD.deb NEW.deb ...]
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import resource
+import subprocess
+import sys
+import tempfile
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+
+def deb_field(deb: Path, field: str) -> str:
+	"""Return a control field of deb."""
+	return subprocess.run(
+		['dpkg-deb', '--field', str(deb), field],
+		check=True, capture_output=True, text=True
+	).stdout.strip()
+
+def delta_name(old: Path, new: Path) -> str:
+	"""Return the file name nala asks the delta server for, as delta_url builds it."""
+	versions = '_'.join(deb_field(deb, 'Version').replace(':', '%3a') for deb in (old, new))
+	return f"{deb_field(new, 'Package')}_{versions}_{deb_field(new, 'Architecture')}.debdelta"
+
+def child_cpu() -> float:
+	"""Return the CPU seconds used by finished child processes."""
+	usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+	return usage.ru_utime + usage.ru_stime
+
+def sha256(path: Path) -> str:
+	"""Return the sha256 of path."""
+	hash_fun = hashlib.sha256()
+	with path.open('rb') as file:
+		while data := file.read(1024 * 1024):
+			hash_fun.update(data)
+	return hash_fun.hexdigest()
+
+def bench_pair(old: Path, new: Path, deltas: Path) -> tuple[int, int, float]:
+	"""Make the delta from old to new and rebuild new from it.
+
+	Returns the size of the package, the size of the delta and the CPU debpatch used.
+	"""
+	delta = deltas / delta_name(old, new)
+	subprocess.run(['debdelta', str(old), str(new), str(delta)], check=True)
+	rebuilt = deltas / f'{new.name}.rebuilt'
+	cpu = child_cpu()
+	subprocess.run(['debpatch', str(delta), str(old), str(rebuilt)], check=True)
+	cpu = child_cpu() - cpu
+	if sha256(rebuilt) != sha256(new):
+		sys.exit(f'{new.name} rebuilt from the delta does not match')
+	rebuilt.unlink()
+	return new.stat().st_size, delta.stat().st_size, cpu
+
+class DeltaHandler(SimpleHTTPRequestHandler):
+	"""Serve deltas by file name, whatever directory they're asked for in."""
+
+	def translate_path(self, path: str) -> str:
+		"""Map the request to the delta of the same name.
+
+		The name isn't unquoted, the %3a nala writes for an epoch is part of the file name.
+		"""
+		return str(Path(self.directory) / path.split('?')[0].rsplit('/', 1)[-1])
+
+def serve(deltas: Path, port: int) -> None:
+	"""Serve the deltas until interrupted."""
+	server = ThreadingHTTPServer(
+		('127.0.0.1', port), partial(DeltaHandler, directory=str(deltas))
+	)
+	print(f'Nala::Download::Delta-Server "http://127.0.0.1:{port}/";')
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+
+def main() -> None:
+	"""Benchmark each pair of packages, then serve the deltas if asked."""
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('debs', nargs='+', type=Path, help='old and new package pairs')
+	parser.add_argument('--serve', type=int, metavar='PORT', help='serve the deltas on PORT')
+	args = parser.parse_args()
+	if len(args.debs) % 2:
+		parser.error('packages must come in old and new pairs')
+
+	with tempfile.TemporaryDirectory(prefix='nala-delta-') as tmp:
+		deltas = Path(tmp)
+		total_size = total_delta = 0
+		total_cpu = 0.0
+		print(f"{'Package':<40} {'Size':>12} {'Delta':>12} {'Saved':>7} {'CPU':>7}")
+		for old, new in zip(args.debs[::2], args.debs[1::2]):
+			size, delta, cpu = bench_pair(old, new, deltas)
+			total_size += size
+			total_delta += delta
+			total_cpu += cpu
+			print(f"{new.name:<40} {size:>12} {delta:>12} {1 - delta / size:>7.1%} {cpu:>6.2f}s")
+		saved = total_size - total_delta
+		print(f"{'Total':<40} {total_size:>12} {total_delta:>12} {saved / total_size:>7.1%} "
+			f"{total_cpu:>6.2f}s")
+		if total_cpu:
+			print(f'{saved / total_cpu / 1_000_000:.1f} MB saved per CPU second')
+		if args.serve:
+			serve(deltas, args.serve)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+#                 __
+#    ____ _____  |  | _____
+#   /    \\__  \ |  | \__  \
+#  |   |  \/ __ \|  |__/ __ \_
+#  |___|  (____  /____(____  /
+#       \/     \/          \/
+#
+# Copyright (C) 2021, 2022 Blake Lee
+#
+# This file is part of nala
+#
+# nala is program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# nala is program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with nala.  If not, see <https://www.gnu.org/licenses/>.
+"""Measure the CPU cost per GiB of drawing the download progress.
+
+Streams hand chunks to the progress the way aiter_bytes does, paced to --rate so the
+fixed rate redraws run for as long as they would during a real download.
+
+	none       count the bytes and never draw, the cost of the loop itself
+	per-chunk  advance the bar and rebuild the panel for every chunk, as nala used to
+	fixed-rate count the bytes and redraw Nala::Download::Refresh-Rate times a second
+
+Run it from a checkout with python3 benchmarks/progress_cpu.py
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+from rich.console import Console
+from rich.panel import Panel
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+# pylint: disable=wrong-import-position,duplicate-code
+from nala.rich import Live, Table, Text, pkg_download_progress
+
+GIB = 1024 ** 3
+# Chunks are paced in bursts this large, so the sleeps don't swamp what we measure
+BURST = 1024 * 1024
+
+class Bench: # pylint: disable=too-few-public-methods
+	"""Feed chunks to the download progress and time the CPU it takes."""
+
+	def __init__(self, args: argparse.Namespace, mode: str) -> None:
+		"""Feed chunks to the download progress and time the CPU it takes."""
+		self.args = args
+		self.mode = mode
+		self.total = int(args.size * GIB)
+		self.pending_data = 0
+		self.count = 0
+		self.task = pkg_download_progress.add_task("", total=self.total)
+		self.live: Live
+
+	def _gen_table(self) -> Panel:
+		"""Generate the same panel as PkgDownloader._gen_table."""
+		table = Table.grid()
+		table.add_row(Text.from_markup(f"[bold green]Total Packages:[/] {self.count}/1"))
+		table.add_row(Text.from_markup("[bold green]Last Completed:[/] bench_1.0_amd64.deb"))
+		pkg_download_progress.advance(self.task, advance=self.pending_data)
+		self.pending_data = 0
+		table.add_row(pkg_download_progress.get_renderable())
+		return Panel(
+			table, title='[bold white]Downloading...', title_align='left', border_style='bold green'
+		)
+
+	def _update_progress(self, len_data: int) -> None:
+		"""Account for a chunk the way the mode under test does."""
+		if self.mode == 'per-chunk':
+			pkg_download_progress.advance(self.task, advance=len_data)
+			self.live.update(self._gen_table())
+		else:
+			self.pending_data += len_data
+
+	async def _stream(self, size: int) -> None:
+		"""Hand size bytes to the progress in chunks, paced to the stream's share of --rate."""
+		loop = asyncio.get_running_loop()
+		rate = self.args.rate * 1_000_000 / self.args.streams
+		deadline = loop.time()
+		sent = 0
+		while sent < size:
+			burst = min(BURST, size - sent)
+			for _ in range(burst // self.args.chunk):
+				self._update_progress(self.args.chunk)
+			self._update_progress(burst % self.args.chunk)
+			sent += burst
+			deadline += burst / rate
+			await asyncio.sleep(max(deadline - loop.time(), 0))
+
+	async def _render(self) -> None:
+		"""Redraw the progress at a fixed rate, as PkgDownloader._render does."""
+		while True:
+			self.live.update(self._gen_table(), refresh=True)
+			await asyncio.sleep(1 / self.args.refresh)
+
+	async def run(self) -> float:
+		"""Return the CPU seconds spent per GiB."""
+		share = self.total // self.args.streams
+		with open(os.devnull, 'w', encoding='utf-8') as devnull:
+			console = Console(file=devnull, force_terminal=True, width=100)
+			# The old Live built the panel itself on its own refresh thread
+			if self.mode == 'per-chunk':
+				live = Live(get_renderable=self._gen_table, console=console)
+			else:
+				live = Live(auto_refresh=False, console=console)
+			cpu = time.process_time()
+			with live as self.live:
+				if self.mode == 'fixed-rate':
+					render = asyncio.get_running_loop().create_task(self._render())
+				await asyncio.gather(*(self._stream(share) for _ in range(self.args.streams)))
+				if self.mode == 'fixed-rate':
+					render.cancel()
+				self.count = 1
+				self.live.update(self._gen_table(), refresh=True)
+			cpu = time.process_time() - cpu
+		pkg_download_progress.remove_task(self.task)
+		return cpu * GIB / self.total
+
+def main() -> None:
+	"""Run each mode and print its CPU cost per GiB."""
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--size', type=float, default=1, help='GiB to download (default 1)')
+	parser.add_argument('--rate', type=float, default=100, help='link speed in MB/s (default 100)')
+	parser.add_argument('--streams', type=int, default=16, help='transfers at once (default 16)')
+	parser.add_argument('--chunk', type=int, default=16384, help='bytes per chunk (default 16384)')
+	parser.add_argument('--refresh', type=int, default=10, help='redraws a second (default 10)')
+	parser.add_argument(
+		'--mode', choices=('none', 'per-chunk', 'fixed-rate'), action='append',
+		help='mode to run, can be repeated (default all)'
+	)
+	args = parser.parse_args()
+	for mode in args.mode or ('none', 'per-chunk', 'fixed-rate'):
+		print(f"{mode:<10} {asyncio.run(Bench(args, mode).run()):8.3f} CPU seconds per GiB")
+
+if __name__ == '__main__':
+	main()
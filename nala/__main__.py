@@ -28,8 +28,9 @@ import sys
 from getpass import getuser
 from typing import NoReturn
 
-from nala.constants import (ARCHIVE_DIR, CAT_ASCII, ERROR_PREFIX,
-				LISTS_PARTIAL_DIR, PARTIAL_DIR, PKGCACHE, SRCPKGCACHE)
+from nala.constants import (ARCHIVE_DIR, ARCHIVE_INDEX,
+				CAT_ASCII, ERROR_PREFIX, LISTS_PARTIAL_DIR,
+				MIRROR_LISTS, PARTIAL_DIR, PKGCACHE, SRCPKGCACHE)
 from nala.fetch import fetch
 from nala.history import history, history_clear, history_info, history_undo
 from nala.logger import dprint, esyslog
@@ -123,6 +124,8 @@ def clean() -> None:
 		dprint(f'Removing {SRCPKGCACHE}')
 	PKGCACHE.unlink(missing_ok=True)
 	SRCPKGCACHE.unlink(missing_ok=True)
+	ARCHIVE_INDEX.unlink(missing_ok=True)
+	MIRROR_LISTS.unlink(missing_ok=True)
 	print("Cache has been cleaned")
 
 def nala_history(apt: Nala) -> None:
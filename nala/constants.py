@@ -41,6 +41,14 @@ NALA_SOURCES = Path('/etc/apt/sources.list.d/nala-sources.list')
 """/etc/apt/sources.list.d/nala-sources.list"""
 NALA_DIR = Path('/var/lib/nala')
 """/var/lib/nala"""
+ARCHIVE_INDEX = NALA_DIR / 'archives.json'
+"""/var/lib/nala/archives.json"""
+MIRROR_LISTS = NALA_DIR / 'mirror-lists.json'
+"""/var/lib/nala/mirror-lists.json"""
+FETCH_SCORES = NALA_DIR / 'fetch-scores.json'
+"""/var/lib/nala/fetch-scores.json"""
+MASTER_LISTS = NALA_DIR / 'master-lists'
+"""/var/lib/nala/master-lists"""
 NALA_LOGDIR = Path('/var/log/nala')
 """/var/log/nala"""
 NALA_LOGFILE = NALA_LOGDIR / 'nala.log'
@@ -208,13 +216,6 @@ The full licence for each library can be found in:
 
 After this page the full GPLv3 will be displayed.
 
-==============================================================================
-PythonPing: https://github.com/alessandromaggio/pythonping
-==============================================================================
-
-MIT License
-Copyright (c) 2018 Alessandro Maggio
-
 ==============================================================================
 Rich: https://github.com/Textualize/rich
 ==============================================================================
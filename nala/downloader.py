@@ -27,143 +27,767 @@
 from __future__ import annotations
 
 import asyncio
+import hashlib
+import os
 import re
+import resource
+import shutil
+import ssl
 import sys
-from asyncio import AbstractEventLoop, Semaphore, gather
+from asyncio import AbstractEventLoop, PriorityQueue, Semaphore, gather
 from errno import ENOENT
-from functools import partial
+from functools import lru_cache, partial
+from importlib.util import find_spec
 from pathlib import Path
 from random import shuffle
 from signal import Signals  # pylint: disable=no-name-in-module #Codacy
 from signal import SIGINT, SIGTERM
-from typing import Pattern
+from time import monotonic
+from typing import TYPE_CHECKING, Callable, Pattern
+from urllib.parse import unquote, urlsplit
 
 import apt_pkg
 from anyio import open_file
 from apt.package import Package, Version
-from httpx import (URL, AsyncClient, ConnectError, ConnectTimeout, HTTPError,
-				HTTPStatusError, Proxy, RemoteProtocolError, RequestError, get)
+from httpx import (URL, AsyncClient, ConnectError, ConnectTimeout,
+				HTTPError, HTTPStatusError, Limits, Proxy, RemoteProtocolError,
+				RequestError, Response, create_ssl_context)
 from rich.panel import Panel
 
 from nala.constants import (ARCHIVE_DIR, ERRNO_PATTERN,
 				ERROR_PREFIX, PARTIAL_DIR, ExitCode)
+from nala.mirrors import (TIMEOUT, MirrorLists, MirrorScores,
+				ProxyDetector, acquire_key, acquire_timeout)
 from nala.rich import Live, Table, Text, pkg_download_progress
-from nala.utils import (check_pkg, color, dprint,
-				get_pkg_name, pkg_candidate, term, unit_str, vprint)
+from nala.transfer import (MAX_PARALLEL, SEGMENT_COUNT, STALL_RATE,
+				BandwidthLimiter, ConcurrencyController, ConnectionStats,
+				DownloadJob, StallWatch, Transfer, TransferStalled, copy_local,
+				resume_headers, resume_offset, retry_delay, save_validators,
+				split_ranges, valid_content_range)
+from nala.utils import (archive_index, check_digest, check_hash,
+				check_pkg, color, dprint, get_hash, get_pkg_name, hash_file,
+				pkg_candidate, term, unit_str, vprint)
+
+if TYPE_CHECKING:
+	from hashlib import _Hash
 
 MIRROR_PATTERN = re.compile(r'mirror://([A-Za-z_0-9.-]+).*')
+# How many times per second the download progress is redrawn
+REFRESH_RATE = max(apt_pkg.config.find_i('Nala::Download::Refresh-Rate', 10), 1)
+# Local repositories are linked or copied into the archive instead of downloaded
+LOCAL_SCHEMES = ('file', 'copy')
+# Once every url of a package has failed it waits and starts over on all of them, this many times
+RETRY_ROUNDS = max(apt_pkg.config.find_i('Nala::Download::Retry-Rounds', 2), 0)
+# Upgrades rebuild the new package from the installed one with a debdelta from this server
+DELTA_SERVER = apt_pkg.config.find('Nala::Download::Delta-Server')
+DEBPATCH = shutil.which('debpatch') if DELTA_SERVER else None
+# apt_pkg fetches what nala couldn't, as a last resort
+APT_FALLBACK = apt_pkg.config.find_b('Nala::Download::Apt-Fallback', True)
+# HTTP/2 lets one connection carry every transfer to a mirror, it needs the h2 package.
+# A Pipeline-Depth of 0 is how apt is told not to send requests over a busy connection
+HTTP2 = (
+	find_spec('h2') is not None and apt_pkg.config.find_b('Nala::Download::HTTP2', True)
+	and apt_pkg.config.find_i('Acquire::http::Pipeline-Depth', 10) > 0
+)
+# Seconds an idle connection is kept open for the next package from that mirror
+KEEPALIVE_EXPIRY = apt_pkg.config.find_i('Nala::Download::Keep-Alive', 30)
+# Once nothing is waiting to start, a transfer expected to take HEDGE_FACTOR times the
+# median is raced against another mirror, if it has more than HEDGE_MIN seconds to go
+HEDGE = apt_pkg.config.find_b('Nala::Download::Hedge', True)
+HEDGE_FACTOR = 2
+HEDGE_MIN = 5
+HEDGE_INTERVAL = 1
 
 class PkgDownloader: # pylint: disable=too-many-instance-attributes
 	"""Manage Package Downloads."""
 
-	def __init__(self, pkgs: list[Package]) -> None:
-		"""Manage Package Downloads."""
+	def __init__(self, pkgs: list[Package],
+		order: dict[str, int] | None = None,
+		on_ready: Callable[[str], None] | None = None) -> None:
+		"""Manage Package Downloads.
+
+		order maps archive names to their place in the install order.
+		on_ready is called with the archive name once it's verified and in the archive.
+		"""
 		self.pkgs = pkgs
+		self.order = order or {}
+		self.on_ready = on_ready
 		self.total_pkgs: int = len(self.pkgs)
 		self.count: int = 0
 		self.live: Live
-		self.mirrors: list[str] = []
+		# mirrors.txt of each mirror:// domain, fetched once the downloads start
+		self.mirrors: dict[str, list[str]] = {}
 		self.last_completed: str = ''
-		self.task = pkg_download_progress.add_task(
-			"", total=sum(pkg_candidate(pkg).size for pkg in self.pkgs)
-		)
-		self.pkg_urls: list[list[Version | str]] = []
-		self._set_pkg_urls()
-		self.pkg_urls = sorted(self.pkg_urls, key=sort_pkg_size, reverse=True)
+		# Bytes downloaded since the progress was last drawn
+		self.pending_data: int = 0
+		self.total_data = sum(pkg_candidate(pkg).size for pkg in self.pkgs)
+		self.task = pkg_download_progress.add_task("", total=self.total_data)
+		self.jobs: list[DownloadJob] = []
+		self._set_jobs()
+		self.queue: PriorityQueue[DownloadJob]
 		self.proxy: dict[URL | str, URL | str | Proxy | None] = {}
+		self.detector = ProxyDetector()
 		self.failed: list[str] = []
 		self.exit: int | bool = False
+		self.scores = MirrorScores()
+		self.controller: ConcurrencyController
+		# Hashes of the archives already in the cache, started before any network setup
+		self.cached: dict[DownloadJob, asyncio.Task[bool]] = {}
+		self.limiter: BandwidthLimiter
+		self.patching: Semaphore
+		# Transfers in flight and how long finished ones took, for hedging
+		self.transfers: set[Transfer] = set()
+		self.durations: list[float] = []
+		self.stats = ConnectionStats()
+		# Packages rebuilt from a debdelta, and the bytes that saved
+		self.deltas = 0
+		self.delta_saved = 0
 		self._set_proxy()
 
 	async def start_download(self) -> bool:
 		"""Start async downloads."""
 		if not self.pkgs:
 			return True
-		semaphore = Semaphore(min(guess_concurrent(self.pkg_urls), 16))
-		with Live(get_renderable=self._gen_table) as self.live:
-			async with AsyncClient(follow_redirects=True, timeout=20, proxies=self.proxy) as client:
+		if DELTA_SERVER and not DEBPATCH:
+			print(
+				f"{color('Warning:', 'YELLOW')} Nala::Download::Delta-Server is set "
+				"but debpatch is not installed, downloading full packages"
+			)
+		self.controller = ConcurrencyController()
+		self.limiter = BandwidthLimiter()
+		# debpatch is CPU bound, so run one for each CPU at most
+		self.patching = Semaphore(os.cpu_count() or 1)
+		children = resource.getrusage(resource.RUSAGE_CHILDREN)
+		self.queue = PriorityQueue()
+		for job in self.jobs:
+			self.queue.put_nowait(job)
+		with Live(auto_refresh=False) as self.live:
+			await self._prepare()
+			async with self._client() as client:
 				loop = asyncio.get_running_loop()
-				tasks = (
-					loop.create_task(
-						self._init_download(client, urls, semaphore)
-					) for urls in self.pkg_urls
-				)
+				# Transfers only count bytes, drawing happens here at a fixed rate
+				render = loop.create_task(self._render())
+				adjust = loop.create_task(self.controller.run())
+				hedger = loop.create_task(self._hedger())
+				# A fixed pool of workers serves the queue, the controller decides how many are busy
+				workers = [
+					loop.create_task(self._worker(client))
+					for _ in range(min(MAX_PARALLEL, len(self.jobs)))
+				]
+				join = loop.create_task(self.queue.join())
 				# Setup handlers for Interrupts
 				for signal_enum in (SIGINT, SIGTERM):
 					exit_func = partial(self.interrupt, signal_enum, loop)
 					loop.add_signal_handler(signal_enum, exit_func)
 
-				return all(await gather(*tasks))
+				try:
+					done, _pending = await asyncio.wait(
+						(join, *workers), return_when=asyncio.FIRST_COMPLETED
+					)
+					# Workers never return, so this only raises if one of them crashed
+					for task in done:
+						task.result()
+				finally:
+					for task in (render, adjust, hedger, join, *workers):
+						task.cancel()
+					archive_index.save()
+				self.live.update(self._gen_table(), refresh=True)
+				self._report(children)
+				return not self.failed
 
-	async def _stream_deb(self, client: AsyncClient, url: str, dest: Path) -> int:
-		"""Stream the deb package and write it to file."""
-		total_data = 0
-		async with client.stream('GET', url) as response:
-			async with await open_file(dest, mode="wb") as file:
-				async for data in response.aiter_bytes():
-					if data:
-						await file.write(data)
-						len_data = len(data)
-						total_data += len_data
-						await self._update_progress(len_data)
-		return total_data
+	def _report(self, children: resource.struct_rusage) -> None:
+		"""Print how the mirrors, connections and deltas did.
 
-	async def _download(self,
-		client: AsyncClient, semaphore: Semaphore,
-		candidate: Version, url: str) -> int:
-		"""Download and write package."""
-		dest = PARTIAL_DIR / get_pkg_name(candidate)
-		async with semaphore:
+		children is the usage of child processes from before the downloads started.
+		"""
+		dprint(f'Mirror scores: {self.scores.mirrors}')
+		vprint(
+			color('Connections: ', 'BLUE')
+			+f"{self.stats.opened} opened, {self.stats.reused()} reused, "
+			f"{self.stats.http2} of {self.stats.requests} requests over HTTP/2"
+		)
+		dprint(self.stats)
+		if self.deltas:
+			usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+			cpu = usage.ru_utime + usage.ru_stime - children.ru_utime - children.ru_stime
 			vprint(
-				color('Starting Download: ', 'BLUE')
-				+f"{url} {unit_str(candidate.size, 1)}"
+				color('Deltas: ', 'BLUE')
+				+f"{self.deltas} packages patched, {unit_str(self.delta_saved, 1)} "
+				f"saved for {cpu:.1f}s of CPU"
 			)
-			assert isinstance(url, str)
-			second_attempt = False
-			while True:
-				try:
-					total_data = await self._stream_deb(client, url, dest)
-					break
-				# Sometimes mirrors play a little dirty and close the connection
-				# Before we're done, so we catch this and try one more time.
-				except RemoteProtocolError as error:
-					if 'Server disconnected' not in str(error) or second_attempt:
-						raise error
-					mirror = url[:url.index('/pool')]
-					vprint(f"{ERROR_PREFIX}{mirror} {error}")
+
+	def _client(self) -> AsyncClient:
+		"""Return a client that keeps connections to the mirrors open between packages."""
+		# Every transfer can hold a connection, and hedges and segments can add more
+		keepalive = MAX_PARALLEL + max(SEGMENT_COUNT, 2)
+		return AsyncClient(
+			follow_redirects=True,
+			timeout=TIMEOUT,
+			proxies=self.proxy,
+			http2=HTTP2,
+			verify=ssl_context(),
+			limits=Limits(
+				# Slots bound what's in flight, this only stops a runaway from exhausting fds
+				max_connections=keepalive * 2,
+				max_keepalive_connections=keepalive,
+				keepalive_expiry=KEEPALIVE_EXPIRY,
+			),
+			event_hooks={
+				'request': [self.stats.request],
+				'response': [self.stats.response],
+			},
+		)
+
+	async def _prepare(self) -> None:
+		"""Start hashing the archives that are already cached, and set up the network for the rest.
+
+		A transaction that may be all cached is checked first, so it never touches the network.
+		"""
+		loop = asyncio.get_running_loop()
+		self.cached = {job: loop.create_task(self._check_cached(job.candidate)) for job in self.jobs}
+		if all(in_archive(job.candidate) for job in self.jobs):
+			await asyncio.wait(self.cached.values())
+		if jobs := [
+			job for job, cached in self.cached.items() if not cached.done() or not cached.result()
+		]:
+			await self._resolve_mirrors(jobs)
+			await self._detect_proxies([url for job in jobs for url in job.urls])
+
+	async def _worker(self, client: AsyncClient) -> None:
+		"""Take jobs from the queue until the downloader is done."""
+		while True:
+			job = await self.queue.get()
+			try:
+				# Wait out the backoff of a retry round without holding a download slot
+				if (wait := job.not_before - monotonic()) > 0:
+					await asyncio.sleep(wait)
+				# Cached archives are hashed in threads, overlapping the first transfers
+				if (cached := self.cached.pop(job, None)) and await cached:
 					continue
+				# Transfers take a download slot once their mirror has room for them
+				await self._run_job(client, job)
+			finally:
+				self.queue.task_done()
+
+	async def _check_cached(self, candidate: Version) -> bool:
+		"""Return True if the archive is already in the cache and verified."""
+		path = ARCHIVE_DIR / get_pkg_name(candidate)
+		if not in_archive(candidate) or not await asyncio.get_running_loop().run_in_executor(
+			None, check_pkg, ARCHIVE_DIR, candidate):
+			return False
+		vprint(color('Already Cached: ', 'GREEN') + path.name)
+		# There is nothing to download, take it out of the totals
+		self.total_pkgs -= 1
+		self.total_data -= candidate.size
+		pkg_download_progress.update(self.task, total=self.total_data)
+		if self.on_ready:
+			self.on_ready(path.name)
+		return True
+
+	async def _stream_deb(self, # pylint: disable=too-many-arguments
+		client: AsyncClient, url: str, dest: Path,
+		candidate: Version, transfer: Transfer | None = None) -> tuple[int, str]:
+		"""Stream the deb package and write it to file.
+
+		The package is hashed as it streams. Returns the bytes written and the digest.
+
+		If a partial file is left over from an earlier attempt we resume it.
+		"""
+		total_data = 0
+		offset = resume_offset(dest, candidate.size)
+		start = monotonic()
+		# A transfer held back by Dl-Limit isn't stalled
+		watch = StallWatch(0 if self.limiter.limited(url) else STALL_RATE)
+		try:
+			async with client.stream(
+				'GET', url, headers=resume_headers(dest, offset, url), timeout=acquire_timeout(url)
+			) as response:
+				self.scores.first_byte(url, monotonic() - start)
+				# Range Not Satisfiable, what we have doesn't match the server's file
+				if response.status_code == 416:
+					dest.unlink(missing_ok=True)
+				response.raise_for_status()
+				self.scores.success(url)
+				offset, hash_fun = await self._resume(response, dest, offset, candidate)
+				total_data += offset
+				self._update_progress(offset)
+				if transfer:
+					transfer.offset = transfer.data = offset
+					transfer.start = monotonic()
+
+				async with await open_file(dest, mode='ab' if offset else 'wb') as file:
+					if not offset:
+						save_validators(dest, response)
+					async for data in response.aiter_bytes():
+						await file.write(data)
+						hash_fun.update(data)
+						total_data += len(data)
+						await self._received(url, len(data), watch, transfer)
+		except (HTTPError, OSError) as error:
+			self.scores.error(url, error)
+			self.controller.error(error)
+			self._update_progress(total_data, failed=True)
+			raise
+		except asyncio.CancelledError:
+			# We lost a hedged race, or are shutting down
+			self._update_progress(total_data, failed=True)
+			raise
+		self.scores.transfer(url, total_data - offset, monotonic() - start)
+		return total_data, hash_fun.hexdigest()
+
+	@staticmethod
+	async def _resume(response: Response,
+		dest: Path, offset: int, candidate: Version) -> tuple[int, _Hash]:
+		"""Return the offset response continues dest from and a hash of the bytes before it.
+
+		The offset is 0 if the server sent the whole file and we start over.
+		"""
+		hash_fun = hashlib.new(get_hash(candidate)[0])
+		if not offset:
+			return 0, hash_fun
+		if response.status_code != 206:
+			# The server ignored our range, or the file changed
+			dprint(f'Unable to resume {dest.name}, server sent the whole file')
+			return 0, hash_fun
+		if not valid_content_range(response, offset, candidate.size):
+			dest.unlink(missing_ok=True)
+			raise HTTPError(f"{response.url} sent an unexpected range for {dest.name}")
+		dprint(f'Resuming {dest.name} at {offset}')
+		# Hash what we already have without blocking the other downloads
+		await asyncio.get_running_loop().run_in_executor(None, hash_file, dest, hash_fun)
+		return offset, hash_fun
+
+	async def _received(self,
+		url: str, len_data: int, watch: StallWatch, transfer: Transfer | None) -> None:
+		"""Count len_data bytes from url, then wait if they put it over its rate limit."""
+		self._update_progress(len_data)
+		if transfer:
+			transfer.data += len_data
+		watch.update(url, len_data)
+		await self.limiter.take(url, len_data)
+
+	async def _download(self, # pylint: disable=too-many-arguments
+		client: AsyncClient, candidate: Version, url: str,
+		dest: Path | None = None, transfer: Transfer | None = None) -> tuple[int, str]:
+		"""Download and write package."""
+		dest = dest or PARTIAL_DIR / get_pkg_name(candidate)
+		vprint(
+			color('Starting Download: ', 'BLUE')
+			+f"{url} {unit_str(candidate.size, 1)}"
+		)
+		second_attempt = False
+		while True:
+			try:
+				# A slot is only taken once the mirror can start the transfer
+				async with self.controller.host(url), self.controller:
+					total_data, digest = await self._stream_deb(
+						client, url, dest, candidate, transfer
+					)
+				break
+			# Sometimes mirrors play a little dirty and close the connection
+			# Before we're done, so we catch this and resume one more time.
+			except RemoteProtocolError as error:
+				if 'Server disconnected' not in str(error) or second_attempt:
+					raise error
+				second_attempt = True
+				mirror = url[:url.index('/pool')]
+				vprint(f"{ERROR_PREFIX}{mirror} {error}")
+				continue
+			except asyncio.CancelledError:
+				# A probe that never finished can't keep the mirror's breaker open
+				self.scores.cancelled(url)
+				raise
+		return total_data, digest
+
+	async def _stream_segment(self, client: AsyncClient,
+		url: str, candidate: Version, byte_range: tuple[int, int]) -> int:
+		"""Stream a byte range of the deb package into its place in the file."""
+		start, end = byte_range
+		total_data = 0
+		started = monotonic()
+		watch = StallWatch(0 if self.limiter.limited(url) else STALL_RATE)
+		try:
+			async with client.stream(
+				'GET', url, headers={'Range': f'bytes={start}-{end}'}, timeout=acquire_timeout(url)
+			) as response:
+				self.scores.first_byte(url, monotonic() - started)
+				response.raise_for_status()
+				self.scores.success(url)
+				# A 200 means the mirror ignored our range and is sending the whole file
+				if response.status_code != 206:
+					raise HTTPError(f'{url} does not support range requests')
+				if not valid_content_range(response, start, candidate.size, end):
+					raise HTTPError(f'{url} sent the wrong range for {start}-{end}')
+				async with await open_file(
+					PARTIAL_DIR / get_pkg_name(candidate), mode="r+b"
+				) as file:
+					await file.seek(start)
+					async for data in response.aiter_bytes():
+						if data:
+							await file.write(data)
+							len_data = len(data)
+							total_data += len_data
+							self._update_progress(len_data)
+							watch.update(url, len_data)
+							await self.limiter.take(url, len_data)
+			if total_data != end - start + 1:
+				raise HTTPError(f'{url} sent {total_data} bytes for range {start}-{end}')
+		except (HTTPError, OSError) as error:
+			self.scores.error(url, error)
+			self.controller.error(error)
+			self._update_progress(total_data, failed=True)
+			raise
+		self.scores.transfer(url, total_data, monotonic() - started)
 		return total_data
 
-	async def _init_download(self, client: AsyncClient,
-		urls: list[Version | str], semaphore: Semaphore) -> None:
-		"""Download pkgs."""
-		candidate = urls.pop(0)
-		assert isinstance(candidate, Version)
-		for num, url in enumerate(urls):
-			assert isinstance(url, str)
+	async def _fetch_segment(self, client: AsyncClient,
+		urls: list[str], candidate: Version, num: int, byte_range: tuple[int, int]
+	) -> tuple[str, int]:
+		"""Fetch one segment from the first mirror that can serve it, returning that mirror."""
+		start, end = byte_range
+		error: HTTPError | OSError | None = None
+		for offset in range(len(urls)):
+			# Each segment starts on a different mirror to spread the load
+			url = urls[(num + offset) % len(urls)]
+			if self.scores[url].tripped():
+				continue
 			try:
-				total_data = await self._download(client, semaphore, candidate, url)
+				async with self.controller.host(url), self.controller:
+					return url, await self._stream_segment(client, url, candidate, byte_range)
+			except (HTTPError, OSError) as err:
+				vprint(f"{ERROR_PREFIX}{url} {err}")
+				error = err
+		raise error or HTTPError(f'No mirror is available for range {start}-{end}')
 
-				if not await process_downloads(candidate):
-					await self._update_progress(total_data, failed=True)
-					continue
-				if not check_pkg(ARCHIVE_DIR, candidate):
-					await self._update_progress(total_data, failed=True)
-					continue
+	async def _download_segments(self,
+		client: AsyncClient, candidate: Version, urls: list[str]) -> tuple[list[str], int, str]:
+		"""Download the package in segments from multiple mirrors at once.
 
-				vprint(
-					color('Download Complete: ', 'GREEN')
-					+url
+		Segments arrive out of order, so the file is hashed once they're all written.
+		Returns the mirrors that served segments, the bytes received and the digest.
+		"""
+		dest = PARTIAL_DIR / get_pkg_name(candidate)
+		vprint(
+			color('Starting Segmented Download: ', 'BLUE')
+			+f"{Path(candidate.filename).name} {unit_str(candidate.size, 1)}"
+		)
+		async with await open_file(dest, mode="wb") as file:
+			await file.truncate(candidate.size)
+
+		results = await gather(
+			*(self._fetch_segment(client, urls, candidate, num, byte_range)
+			for num, byte_range in enumerate(split_ranges(candidate.size, SEGMENT_COUNT))),
+			return_exceptions=True
+		)
+		total_data = 0
+		served: list[str] = []
+		for result in results:
+			if isinstance(result, BaseException):
+				# Roll back the segments that did finish, we're starting over
+				self._update_progress(
+					sum(data[1] for data in results if isinstance(data, tuple)), failed=True
 				)
+				dest.unlink(missing_ok=True)
+				raise result
+			url, data = result
+			total_data += data
+			if url not in served:
+				served.append(url)
+		hash_fun = await asyncio.get_running_loop().run_in_executor(
+			None, hash_file, dest, hashlib.new(get_hash(candidate)[0])
+		)
+		return served, total_data, hash_fun.hexdigest()
 
-				self.count += 1
-				self.last_completed = Path(candidate.filename).name
-				self.live.update(self._gen_table())
-				break
+	async def _finish_download(self,
+		candidate: Version, urls: list[str], total_data: int, digest: str) -> bool:
+		"""Check the digest of the finished download and move it into the archive."""
+		if not check_digest(candidate, digest):
+			# Segments can't be checked alone, so every mirror that sent one shares the blame
+			for url in urls:
+				self.scores.error(url)
+			self._update_progress(total_data, failed=True)
+			# Don't let the next mirror resume from a bad file
+			(PARTIAL_DIR / get_pkg_name(candidate)).unlink(missing_ok=True)
+			return False
+		return await self._complete(candidate, ' '.join(urls), total_data)
 
+	async def _copy_local(self, candidate: Version, url: str) -> bool:
+		"""Link or copy the package from a local repository, then verify it."""
+		source = Path(unquote(urlsplit(url).path))
+		dest = PARTIAL_DIR / get_pkg_name(candidate)
+		vprint(color('Copying: ', 'BLUE') + f"{source} {unit_str(candidate.size, 1)}")
+		loop = asyncio.get_running_loop()
+		try:
+			# apt uses file: archives where they are, so a hardlink is as good
+			await loop.run_in_executor(
+				None, copy_local, source, dest, urlsplit(url).scheme == 'file'
+			)
+		except OSError as error:
+			vprint(f"{ERROR_PREFIX}{source} {error}")
+			return False
+		if not await loop.run_in_executor(None, check_pkg, PARTIAL_DIR, candidate):
+			vprint(f"{ERROR_PREFIX}{source} does not match the package")
+			dest.unlink(missing_ok=True)
+			return False
+		self._update_progress(candidate.size)
+		return await self._complete(candidate, url, candidate.size)
+
+	async def _patch_delta(self, client: AsyncClient, job: DownloadJob) -> bool:
+		"""Rebuild the package from the installed version and a debdelta, then verify it.
+
+		Returns False if there is no delta or it didn't work, the full package is used then.
+		"""
+		candidate = job.candidate
+		url, job.delta = str(job.delta), None
+		name = get_pkg_name(candidate)
+		delta = PARTIAL_DIR / f'{name}.debdelta'
+		# Rebuilt beside the partial so a resumable download survives a bad patch
+		patched = PARTIAL_DIR / f'{name}.patched'
+		delta_size = 0
+		try:
+			async with self.controller, client.stream(
+				'GET', url, timeout=acquire_timeout(url)
+			) as response:
+				if response.status_code == 404:
+					dprint(f'No delta for {name} at {url}')
+					return False
+				response.raise_for_status()
+				async with await open_file(delta, mode="wb") as file:
+					async for data in response.aiter_bytes():
+						await file.write(data)
+						delta_size += len(data)
+						await self.limiter.take(url, len(data))
+			await self._debpatch(delta, patched, candidate)
+			patched.replace(PARTIAL_DIR / name)
+		except (HTTPError, OSError) as error:
+			vprint(f"{ERROR_PREFIX}{url} {error}")
+			return False
+		finally:
+			delta.unlink(missing_ok=True)
+			patched.unlink(missing_ok=True)
+		vprint(color('Patched: ', 'GREEN') + f"{name} from a {unit_str(delta_size, 1)} delta")
+		self._update_progress(candidate.size)
+		if not await self._complete(candidate, url, candidate.size):
+			return False
+		self.deltas += 1
+		self.delta_saved += candidate.size - delta_size
+		return True
+
+	async def _debpatch(self, delta: Path, patched: Path, candidate: Version) -> None:
+		"""Rebuild candidate at patched from the installed version, raising OSError if it's wrong."""
+		async with self.patching:
+			# '/' tells debpatch the old version is the one installed
+			process = await asyncio.create_subprocess_exec(
+				str(DEBPATCH), str(delta), '/', str(patched),
+				stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+			)
+			_out, err = await process.communicate()
+		if process.returncode:
+			raise OSError(f'debpatch failed, {err.decode().strip()}')
+		loop = asyncio.get_running_loop()
+		if patched.stat().st_size != candidate.size or not await loop.run_in_executor(
+			None, check_hash, patched, *get_hash(candidate)
+		):
+			raise OSError(f'{patched.stem} rebuilt from the delta does not match the package')
+
+	async def _complete(self, candidate: Version, url: str, total_data: int) -> bool:
+		"""Move a verified package into the archive and count it as done."""
+		if not await process_downloads(candidate):
+			self._update_progress(total_data, failed=True)
+			return False
+		# The package has been verified, so the next run won't need to hash it
+		archive_index.add(ARCHIVE_DIR / get_pkg_name(candidate), *get_hash(candidate))
+
+		vprint(
+			color('Download Complete: ', 'GREEN')
+			+url
+		)
+
+		self.count += 1
+		self.last_completed = Path(candidate.filename).name
+		if self.on_ready:
+			self.on_ready(get_pkg_name(candidate))
+		return True
+
+	async def _run_job(self, client: AsyncClient, job: DownloadJob) -> None:
+		"""Make one attempt at a job, putting it back in the queue if it fails."""
+		candidate = job.candidate
+		if not job.urls:
+			self.retry(job)
+			return
+		if job.delta and await self._patch_delta(client, job):
+			return
+		# A local repository is always quicker than the network
+		if local := next((url for url in job.urls if urlsplit(url).scheme in LOCAL_SCHEMES), None):
+			job.urls.remove(local)
+			if not await self._copy_local(candidate, local):
+				self.retry(job)
+			return
+		# Mirrors are ranked now rather than up front so we use what we've learned
+		mirrors = self.scores.order(job.urls, candidate.size)
+		# Skip mirrors that are down, and prefer ones with a free connection
+		mirrors.sort(
+			key=lambda url: (self.scores[url].tripped(), self.controller.host(url).locked())
+		)
+		dest = PARTIAL_DIR / get_pkg_name(candidate)
+		healthy = [url for url in mirrors if not self.scores[url].tripped()]
+
+		# A partial file left from before is resumed instead of starting segments
+		if job.segmented and healthy and not resume_offset(dest, candidate.size):
+			job.segmented = False
+			try:
+				served, total_data, digest = await self._download_segments(
+					client, candidate, healthy
+				)
+				if not await self._finish_download(candidate, served, total_data, digest):
+					self.retry(job)
 			except (HTTPError, OSError) as error:
-				self.download_error(error, num, urls, candidate)
+				vprint(
+					color('Segmented Download Failed: ', 'YELLOW')
+					+f"{job.name} {error}"
+				)
+				self.retry(job)
+			return
+
+		job.segmented = False
+		url = mirrors[0]
+		job.urls.remove(url)
+		# Every mirror left is down, fail fast rather than wait on another timeout
+		if not self.scores.allow(url):
+			vprint(color('Mirror Skipped: ', 'YELLOW') + url)
+			self.retry(job)
+			return
+		resumed = bool(resume_offset(dest, candidate.size))
+		try:
+			url, total_data, digest = await self._race(client, job, url)
+			if not await self._finish_download(candidate, [url], total_data, digest):
+				# The bad data may have come from the partial file, give the mirror another go
+				if resumed:
+					job.urls.append(url)
+				self.retry(job)
+		except (HTTPError, OSError) as error:
+			self.download_error(error, url, job)
+
+	async def _race(self,
+		client: AsyncClient, job: DownloadJob, url: str) -> tuple[str, int, str]:
+		"""Download job from url, racing another mirror if the transfer falls behind.
+
+		Returns the url that won, the bytes written and the digest.
+		"""
+		transfer = Transfer(job, url)
+		self.transfers.add(transfer)
+		primary = asyncio.create_task(self._download(client, job.candidate, url, transfer=transfer))
+		hedged = asyncio.create_task(transfer.hedge.wait())
+		try:
+			await asyncio.wait((primary, hedged), return_when=asyncio.FIRST_COMPLETED)
+			if primary.done() or not (hedge_url := self._hedge_url(job)):
+				total_data, digest = await primary
+				self.durations.append(monotonic() - transfer.start)
+				return url, total_data, digest
+			return await self._hedge(client, job, (url, primary), hedge_url)
+		finally:
+			self.transfers.discard(transfer)
+			hedged.cancel()
+			primary.cancel()
+
+	async def _hedge(self, client: AsyncClient, job: DownloadJob,
+		primary: tuple[str, asyncio.Task[tuple[int, str]]], hedge_url: str) -> tuple[str, int, str]:
+		"""Race the primary transfer against hedge_url, the first to finish wins."""
+		name = get_pkg_name(job.candidate)
+		dest = PARTIAL_DIR / name
+		hedge_dest = PARTIAL_DIR / f'{name}.hedge'
+		hedge_dest.unlink(missing_ok=True)
+		vprint(color('Hedging: ', 'BLUE') + hedge_url)
+		hedge = asyncio.create_task(
+			self._download(client, job.candidate, hedge_url, dest=hedge_dest)
+		)
+		racers = {primary[1]: primary[0], hedge: hedge_url}
+		pending = set(racers)
+		try:
+			while pending:
+				done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+				for task in done:
+					if task.exception():
+						continue
+					total_data, digest = task.result()
+					if task is hedge:
+						# The hedge won, its file takes the place of the primary's
+						primary[1].cancel()
+						await asyncio.gather(primary[1], return_exceptions=True)
+						hedge_dest.replace(dest)
+					else:
+						job.urls.append(hedge_url)
+					vprint(color('Race Won: ', 'GREEN') + racers[task])
+					return racers[task], total_data, digest
+			# Both failed, report the primary's error
+			hedge_dest.unlink(missing_ok=True)
+			return primary[0], *await primary[1]
+		finally:
+			hedge.cancel()
+			await asyncio.gather(hedge, return_exceptions=True)
+			hedge_dest.unlink(missing_ok=True)
+
+	def _hedge_url(self, job: DownloadJob) -> str | None:
+		"""Take the best healthy url left for job, or None if there isn't one."""
+		for url in self.scores.order(job.urls, job.candidate.size):
+			if not self.scores[url].tripped():
+				job.urls.remove(url)
+				return url
+		return None
+
+	async def _hedger(self) -> None:
+		"""Mark transfers for hedging once the queue has drained."""
+		while HEDGE:
+			await asyncio.sleep(HEDGE_INTERVAL)
+			# Hedging only uses bandwidth nothing else is waiting for
+			if not self.queue.empty() or self.controller.active >= self.controller.limit:
 				continue
+			estimates = {
+				transfer: monotonic() - transfer.start + transfer.eta()
+				for transfer in self.transfers if transfer.rate()
+			}
+			durations = sorted((*self.durations, *estimates.values()))
+			if not durations:
+				continue
+			median = durations[len(durations) // 2]
+			for transfer, duration in estimates.items():
+				if (not transfer.hedge.is_set() and transfer.job.urls
+					and duration > median * HEDGE_FACTOR and transfer.eta() > HEDGE_MIN):
+					dprint(
+						f'Hedging {transfer.job.name}, '
+						f'{duration:.1f}s against a median of {median:.1f}s'
+					)
+					transfer.hedge.set()
+
+	def retry(self, job: DownloadJob) -> None:
+		"""Put a failed job back in the queue.
+
+		A job with no urls left starts another round on all of them after a backoff,
+		and is given up on once RETRY_ROUNDS have failed.
+		"""
+		if not job.urls:
+			if job.rounds >= RETRY_ROUNDS or not job.mirrors:
+				vprint(
+					color('No More Mirrors: ', 'RED')
+					+ color(job.name, 'YELLOW')
+				)
+				self.failed.append(job.name)
+				return
+			job.rounds += 1
+			job.urls = list(job.mirrors)
+			# There's no point starting before one of its mirrors is out of cool-down
+			delay = max(
+				retry_delay(job.rounds), min(self.scores[url].cooldown() for url in job.mirrors)
+			)
+			job.not_before = monotonic() + delay
+			vprint(
+				color('Retrying: ', 'YELLOW')
+				+f"{job.name} in {delay:.1f}s ({job.rounds}/{RETRY_ROUNDS})"
+			)
+			self.queue.put_nowait(job)
+			return
+		vprint(color('Requeued: ', 'YELLOW') + job.name)
+		self.queue.put_nowait(job)
 
 	def interrupt(self, signal_enum: Signals, loop: AbstractEventLoop) -> None:
 		"""Shutdown the loop."""
@@ -184,17 +808,67 @@ class PkgDownloader: # pylint: disable=too-many-instance-attributes
 			self.proxy['https://'] = https_proxy
 		if ftp_proxy := apt_pkg.config.find('Acquire::ftp::Proxy'):
 			self.proxy['ftp://'] = ftp_proxy
+		for scheme in ('http', 'https', 'ftp'):
+			# Acquire::http::Proxy::<host> overrides the proxy for that host
+			for host in apt_pkg.config.list(f'Acquire::{scheme}::Proxy'):
+				proxy = apt_pkg.config.find(host)
+				host = host.rsplit('::', 1)[-1]
+				self.proxy[f'{scheme}://{host}'] = None if proxy.upper() == 'DIRECT' else proxy
+		# DIRECT is apt's way of saying don't use a proxy
+		for key, proxy in list(self.proxy.items()):
+			if isinstance(proxy, str) and proxy.upper() == 'DIRECT':
+				del self.proxy[key]
+
+	async def _detect_proxies(self, urls: list[str]) -> None:
+		"""Run Acquire::http::Proxy-Auto-Detect for each host that has no proxy set for it.
+
+		The answers go in self.proxy so each host is only asked about once a run.
+		"""
+		pending: dict[str, tuple[str, str]] = {}
+		for url in urls:
+			parsed = URL(url)
+			origin = f'{parsed.scheme}://{parsed.host}'
+			if parsed.scheme not in ('http', 'https') or origin in self.proxy or origin in pending:
+				continue
+			# ProxyAutoDetect is the name older versions of apt used
+			key = acquire_key(url, 'Proxy-Auto-Detect') or acquire_key(url, 'ProxyAutoDetect')
+			# A proxy set for the host wins over the helper, like it does for apt
+			if not key or apt_pkg.config.exists(f'Acquire::{parsed.scheme}::Proxy::{parsed.host}'):
+				continue
+			pending[origin] = (url, apt_pkg.config.find_file(key))
+		proxies = await gather(
+			*(self.detector.detect(url, helper) for url, helper in pending.values())
+		)
+		for origin, proxy in zip(pending, proxies):
+			# Without an answer the host keeps the proxy apt is configured with
+			if proxy:
+				self.proxy[origin] = None if proxy == 'DIRECT' else proxy
 
-	def _set_pkg_urls(self) -> None:
-		"""Set pkg_urls list."""
+	def _set_jobs(self) -> None:
+		"""Set the download jobs."""
 		for pkg in self.pkgs:
 			candidate = pkg_candidate(pkg)
-			urls: list[Version | str] = []
-			urls.extend(self.filter_uris(candidate, MIRROR_PATTERN))
+			position = self.order.get(get_pkg_name(candidate), len(self.order))
+			# mirror:// uris are filled in by _resolve_mirrors
+			self.jobs.append(
+				DownloadJob(candidate, list(candidate.uris), position, delta_url(pkg, candidate))
+			)
+
+	async def _resolve_mirrors(self, jobs: list[DownloadJob]) -> None:
+		"""Fetch the lists of every mirror:// domain at once, then set the urls of each job."""
+		domains = sorted({
+			regex.group(1) for job in jobs for uri in job.urls
+			if (regex := MIRROR_PATTERN.search(uri))
+		})
+		if domains:
+			await self._detect_proxies([f"http://{domain}/mirrors.txt" for domain in domains])
+			async with self._client() as client:
+				self.mirrors = await MirrorLists().resolve(client, domains)
+		for job in jobs:
+			job.urls = self.filter_uris(job.candidate, MIRROR_PATTERN)
 			# Randomize the urls to minimize load on a single mirror.
-			shuffle(urls)
-			urls.insert(0, candidate)
-			self.pkg_urls.append(urls)
+			shuffle(job.urls)
+			job.mirrors = list(job.urls)
 
 	def filter_uris(self, candidate: Version, pattern: Pattern[str]) -> list[str]:
 		"""Filter uris into usable urls."""
@@ -203,12 +877,7 @@ class PkgDownloader: # pylint: disable=too-many-instance-attributes
 			# Regex to check if we're using mirror.txt
 			if regex := pattern.search(uri):
 				domain = regex.group(1)
-				if not self.mirrors:
-					try:
-						self.mirrors = get(f"http://{domain}/mirrors.txt").text.splitlines()
-					except HTTPError:
-						sys.exit(ERROR_PREFIX+f'unable to connect to http://{domain}/mirrors.txt')
-				urls.extend([link+candidate.filename for link in self.mirrors])
+				urls.extend([link+candidate.filename for link in self.mirrors.get(domain, [])])
 				continue
 			urls.append(uri)
 		return urls
@@ -227,7 +896,8 @@ class PkgDownloader: # pylint: disable=too-many-instance-attributes
 		else:
 			table.add_row(Text.from_ansi(f"{color('Last Completed:', 'GREEN')} {self.last_completed}"))
 
-		pkg_download_progress.advance(self.task, advance=0)
+		pkg_download_progress.advance(self.task, advance=self.pending_data)
+		self.pending_data = 0
 		table.add_row(pkg_download_progress.get_renderable())
 		return Panel(
 			table, title='[bold white]Downloading...', title_align='left', border_style='bold green'
@@ -235,39 +905,39 @@ class PkgDownloader: # pylint: disable=too-many-instance-attributes
 
 	def download_error(self,
 		error: HTTPError | HTTPStatusError | RequestError | OSError | ConnectError,
-		num: int, urls: list[Version | str], candidate: Version) -> None:
+		url: str, job: DownloadJob) -> None:
 		"""Handle download errors."""
-		full_url = str(urls[num])
-		mirror = full_url[:full_url.index('/pool')]
+		mirror = url[:url.index('/pool')]
 		if isinstance(error, ConnectTimeout):
 			vprint(color('Mirror Timedout: ', 'YELLOW') + mirror)
-		if isinstance(error, ConnectError):
+		if isinstance(error, TransferStalled):
+			vprint(color('Transfer Stalled: ', 'YELLOW') + f"{job.name} {error}")
+		elif isinstance(error, ConnectError):
 			# ConnectError: [Errno -2] Name or service not known
 			errno_replace = re.sub(ERRNO_PATTERN, '', str(error)).strip()+':'
 			vprint(f"{color(errno_replace, 'RED')} {mirror}")
 		else:
 			msg = str(error) or type(error).__name__
 			vprint(ERROR_PREFIX + msg)
+		# Acquire::Retries lets the mirror have another go once the others have been tried
+		if job.retries:
+			job.retries -= 1
+			job.urls.append(url)
+		self.retry(job)
 
-		try:
-			# Check if there is another url to try
-			next_url = urls[num+1]
-		except IndexError:
-			vprint(
-				color('No More Mirrors: ', 'RED')
-				+ color(pkg_name := Path(candidate.filename).name, 'YELLOW')
-			)
-			self.failed.append(pkg_name)
-			return
-		vprint(color('Trying: ', 'YELLOW') + str(next_url))
-
-	async def _update_progress(self, len_data: int, failed: bool = False) -> None:
-		"""Update download progress."""
+	def _update_progress(self, len_data: int, failed: bool = False) -> None:
+		"""Count downloaded bytes. They are drawn by _render."""
 		if failed:
 			len_data = -len_data
+		else:
+			self.controller.record(len_data)
+		self.pending_data += len_data
 
-		pkg_download_progress.advance(self.task, advance=len_data)
-		self.live.update(self._gen_table())
+	async def _render(self) -> None:
+		"""Redraw the download progress at a fixed rate."""
+		while True:
+			self.live.update(self._gen_table(), refresh=True)
+			await asyncio.sleep(1 / REFRESH_RATE)
 
 async def process_downloads(candidate: Version) -> bool:
 	"""Process the downloaded packages."""
@@ -287,19 +957,39 @@ async def process_downloads(candidate: Version) -> bool:
 		return False
 	return True
 
-def guess_concurrent(pkg_urls: list[list[Version | str]]) -> int:
-	"""Determine how many concurrent downloads to do."""
-	max_uris = 2
-	for pkg in pkg_urls:
-		max_uris = max(len(pkg[1:])*2, max_uris)
-	return max_uris
+def in_archive(candidate: Version) -> bool:
+	"""Return True if the archive directory has a file the size of candidate."""
+	try:
+		return (ARCHIVE_DIR / get_pkg_name(candidate)).stat().st_size == candidate.size
+	except OSError:
+		return False
+
+def delta_url(pkg: Package, candidate: Version) -> str | None:
+	"""Return where the delta server keeps the debdelta from the installed version to candidate.
+
+	The names follow debdelta-upgrade, epochs are written as %3a.
+	"""
+	if not DEBPATCH or not (installed := pkg.installed) or installed == candidate:
+		return None
+	versions = '_'.join(version.version.replace(':', '%3a') for version in (installed, candidate))
+	delta = f'{pkg.shortname}_{versions}_{candidate.architecture}.debdelta'
+	return f"{DELTA_SERVER.rstrip('/')}/{Path(candidate.filename).parent}/{delta}"
+
+def apt_fallback(failed: list[str]) -> None:
+	"""Report the packages apt_pkg has to fetch, exit if it isn't allowed to."""
+	for name in failed:
+		print(ERROR_PREFIX+f"{name} Failed to download")
+	if not APT_FALLBACK:
+		sys.exit(ERROR_PREFIX+'Some downloads failed and Nala::Download::Apt-Fallback is off.')
+	print(
+		color('Falling back to apt_pkg for: ', 'YELLOW')
+		+', '.join(failed)
+	)
 
-def sort_pkg_size(pkg_url: list[Version | str]) -> int:
-	"""Sort by package size.
+@lru_cache(maxsize=None)
+def ssl_context() -> ssl.SSLContext:
+	"""Return the TLS context shared by every connection nala makes to the mirrors.
 
-	This is to be used as sorted(key=sort_pkg_size)
+	The certificates are loaded once, and ALPN offers HTTP/2 when we can speak it.
 	"""
-	candidate = pkg_url[0]
-	assert isinstance(candidate, Version)
-	assert isinstance(candidate.size, int)
-	return candidate.size
+	return create_ssl_context(http2=HTTP2)
@@ -24,73 +24,333 @@
 """Nala fetch Module."""
 from __future__ import annotations
 
+import asyncio
+import io
 import itertools
+import json
+import os
 import re
-import socket
 import sys
-from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from time import monotonic, time
+from typing import Any, Callable, Iterable, Iterator
+from urllib.parse import urlsplit
 
-from apt_pkg import get_architectures
+from apt_pkg import config, get_architectures
 from aptsources.distro import get_distro
-from httpx import HTTPError, get
-from pythonping import ping
+from httpx import URL, AsyncClient, HTTPError, Limits, Timeout, get
 from rich.progress import TaskID
 
-from nala.constants import (ERRNO_PATTERN, ERROR_PREFIX,
-				NALA_SOURCES, SOURCELIST, SOURCEPARTS)
+from nala.constants import (ERRNO_PATTERN, ERROR_PREFIX, FETCH_SCORES,
+				MASTER_LISTS, NALA_SOURCES, SOURCELIST, SOURCEPARTS)
 from nala.logger import dprint
 from nala.options import arguments, parser
 from nala.rich import Live, Table, fetch_progress
-from nala.utils import ask, color
-
-netselect_scored = []
+from nala.utils import ask, color, unit_str
 
 DEBIAN = 'Debian'
 UBUNTU = 'Ubuntu'
-DOMAIN_PATTERN = re.compile(r'https?://([A-Za-z_0-9.-]+).*')
-UBUNTU_COUNTRY = re.compile(r'<mirror:countrycode>(.*)</mirror:countrycode>')
-UBUNTU_MIRROR = re.compile(r'<link>(.*)</link>')
-
-def net_select(mirror: str, task: TaskID, live: Live, total: int, num: int) -> None:
-	"""Take a URL, ping the domain and score the latency."""
-	debugger = [f'Thread: {num}', f'Current Mirror: {mirror}']
-	ping_progress(live, task, total, num)
-
-	# Regex to get the domain
-	regex = re.search(DOMAIN_PATTERN, mirror)
-	if not regex:
-		debugger.append('Regex Failed')
-		dprint(debugger)
-		return
-	domain = regex.group(1)
-	debugger.append(f'Pinged: {domain}')
+# The fields we want out of an archive mirrors RSS item
+UBUNTU_FIELD = re.compile(r'<(link|mirror:countrycode|mirror:bandwidth)>(.*)</')
+# The Archive-<protocol> fields of a masterlist record
+DEBIAN_PROTOCOLS = ('http', 'https', 'ftp', 'rsync')
+# The territory of a locale like en_US.UTF-8
+LOCALE_COUNTRY = re.compile(r'^[a-z]{2,3}_([A-Z]{2})')
+# Mirrors probed at once, and the seconds each probe gets before the mirror is dropped
+PROBE_CONCURRENCY = max(config.find_i('Nala::Fetch::Probe-Concurrency', 32), 1)
+PROBE_TIMEOUT = 5
+# Mirrors are ranked by how long they'd take to send a package this large
+SCORE_SIZE = 1_000_000
+# Probe every mirror instead of stopping once a wave doesn't turn up better ones
+PROBE_ALL = config.find_b('Nala::Fetch::Probe-All', False)
+# A wave has to make the slowest of the best this much faster for another to be worth it
+WAVE_GAIN = 0.9
+# Seconds a mirror's release can be older than the newest one we've seen
+MAX_LAG = config.find_i('Nala::Fetch::Max-Lag', 43200)
+# The fields we check are at the top of the release file, before the hashes
+RELEASE_HEAD = 8192
+
+class MirrorSite: # pylint: disable=too-many-instance-attributes
+	"""A mirror from the master list."""
+
+	__slots__ = ('url', 'site', 'countries', 'arches', 'protocols', 'bandwidth')
+
+	def __init__(self, site: str) -> None:
+		"""A mirror from the master list."""
+		self.site = site
+		# The http(s) archive, mirrors without one can't be written to our sources
+		self.url = ''
+		self.countries: set[str] = set()
+		# Ubuntu's list doesn't say, these mirrors have them all
+		self.arches: set[str] = set()
+		self.protocols: set[str] = set()
+		# Only Ubuntu's list declares it, in Mbit/s
+		self.bandwidth = 0
+
+	def __repr__(self) -> str:
+		"""Represent the mirror as a string."""
+		return (
+			f'MirrorSite({self.url or self.site}, countries={sorted(self.countries)}, '
+			f'bandwidth={self.bandwidth})'
+		)
+
+	def dump(self) -> list[object]:
+		"""Return the mirror as JSON."""
+		return [
+			self.site, self.url, sorted(self.countries),
+			sorted(self.arches), sorted(self.protocols), self.bandwidth
+		]
+
+	@classmethod
+	def load(cls, data: list[Any]) -> MirrorSite:
+		"""Return the mirror from its JSON."""
+		site = cls(data[0])
+		site.url = data[1]
+		site.countries, site.arches, site.protocols = set(data[2]), set(data[3]), set(data[4])
+		site.bandwidth = data[5]
+		return site
+
+class MirrorList: # pylint: disable=too-few-public-methods
+	"""Every mirror on a master list, indexed by country."""
+
+	def __init__(self, sites: list[MirrorSite]) -> None:
+		"""Every mirror on a master list, indexed by country."""
+		self.sites = sites
+		self.countries: dict[str, list[MirrorSite]] = {}
+		for site in sites:
+			for country in site.countries:
+				self.countries.setdefault(country, []).append(site)
+
+	def select(self, country_list: tuple[str, ...] | None,
+		arches: tuple[str, ...] | tuple[()] = ()) -> tuple[MirrorSite, ...]:
+		"""Return the http(s) mirrors in any of the countries that carry all of the arches."""
+		sites: Iterable[MirrorSite] = self.sites
+		if country_list:
+			# A mirror in two of the countries is only wanted once
+			sites = {
+				site.url: site for country in country_list
+				for site in self.countries.get(country.upper(), ())
+			}.values()
+		return tuple(
+			site for site in sites
+			if site.url and (not site.arches or site.arches.issuperset(arches))
+		)
+
+class MirrorProbe: # pylint: disable=too-many-instance-attributes
+	"""How quickly a mirror connected, answered and sent the release file."""
+
+	__slots__ = ('mirror', 'connect', 'tls', 'ttfb', 'size', 'transfer', 'date', 'error')
+
+	def __init__(self, mirror: str) -> None:
+		"""How quickly a mirror connected, answered and sent the release file."""
+		self.mirror = mirror
+		# Seconds for the TCP connection, the TLS handshake and the response headers
+		self.connect: float = 0
+		self.tls: float = 0
+		self.ttfb: float = 0
+		# Bytes of the release file and the seconds they took to arrive
+		self.size = 0
+		self.transfer: float = 0
+		# The Date of the release file, as a timestamp
+		self.date: float = 0
+		self.error = ''
+
+	def __repr__(self) -> str:
+		"""Represent the probe as a string."""
+		if self.error:
+			return f'MirrorProbe({self.mirror}, error={self.error})'
+		return (
+			f'MirrorProbe({self.mirror}, connect={self.connect:.3f}s, tls={self.tls:.3f}s, '
+			f'ttfb={self.ttfb:.3f}s, speed={unit_str(int(self.throughput()), 0)}/s, '
+			f'score={self.score():.3f})'
+		)
+
+	def throughput(self) -> float:
+		"""Return the bytes per second the release file arrived at."""
+		# A file that came in a single read is as fast as we can tell
+		return self.size / self.transfer if self.transfer else float(self.size)
+
+	def score(self) -> float:
+		"""Return the seconds this mirror would take to send a SCORE_SIZE package."""
+		if self.error or not self.size:
+			return float('inf')
+		return self.connect + self.tls + self.ttfb + SCORE_SIZE / max(self.throughput(), 1)
+
+async def probe_mirror(client: AsyncClient, mirror: str,
+	release: str, arches: tuple[str, ...]) -> MirrorProbe:
+	"""Time fetching the InRelease file of release from mirror.
+
+	Mirrors that only have a Release file are timed on that. Mirrors that don't
+	carry the release for all of the arches, or whose release has expired, get an error.
+	"""
+	probe = MirrorProbe(mirror)
+	marks: dict[str, float] = {}
+
+	async def trace(event: str, _info: dict[str, object]) -> None:
+		marks[event] = monotonic()
+
+	head = b''
+	for name in ('InRelease', 'Release'):
+		marks.clear()
+		start = monotonic()
+		try:
+			async with client.stream(
+				'GET', f"{mirror.rstrip('/')}/dists/{release}/{name}", extensions={'trace': trace}
+			) as response:
+				if response.status_code == 404 and name == 'InRelease':
+					continue
+				if response.is_error:
+					probe.error = f'{response.status_code} {response.reason_phrase}'
+					return probe
+				headers = monotonic()
+				async for data in response.aiter_bytes():
+					if len(head) < RELEASE_HEAD:
+						head += data
+					probe.size += len(data)
+				probe.transfer = monotonic() - headers
+		except (HTTPError, OSError) as error:
+			probe.error = str(error) or type(error).__name__
+			return probe
+		break
+	check_release(probe, release_fields(head), arches)
+	# Redirects open new connections, the marks are from the last one
+	connected = marks.get('connection.connect_tcp.complete', start)
+	probe.connect = connected - marks.get('connection.connect_tcp.started', start)
+	if 'connection.start_tls.complete' in marks:
+		probe.tls = marks['connection.start_tls.complete'] - connected
+		connected = marks['connection.start_tls.complete']
+	probe.ttfb = headers - max(connected, start)
+	return probe
+
+def release_fields(head: bytes) -> dict[str, str]:
+	"""Return the fields at the top of a release file."""
+	fields = {}
+	for line in head.decode('utf-8', 'replace').splitlines():
+		# The hash lists are all that's left, and they're most of the file
+		if line in ('MD5Sum:', 'SHA1:', 'SHA256:', 'SHA512:'):
+			break
+		# InRelease starts with the signature headers, they don't use any of our fields
+		key, sep, value = line.partition(': ')
+		if sep and not line[0].isspace():
+			fields[key] = value.strip()
+	return fields
+
+def release_time(value: str) -> float:
+	"""Return the timestamp of a release file date, 0 if it isn't one."""
+	# Date: Sat, 18 Oct 2026 03:22:01 UTC
 	try:
-		if not netping(domain, mirror, debugger):
+		return parsedate_to_datetime(value).timestamp()
+	except (TypeError, ValueError):
+		return 0
+
+def check_release(probe: MirrorProbe, fields: dict[str, str], arches: tuple[str, ...]) -> None:
+	"""Set an error on the probe if its release file is of no use to us."""
+	probe.date = release_time(fields.get('Date', ''))
+	# Architectures: amd64 arm64 armel armhf i386 mips64el mipsel ppc64el s390x
+	if 'Architectures' in fields:
+		if missing := set(arches).difference(fields['Architectures'].split()):
+			probe.error = f"Release doesn't have {', '.join(sorted(missing))}"
 			return
-	except (socket.gaierror, RuntimeError) as err:
-		ping_error(str(err), domain, mirror)
-
-def netping(domain: str, mirror: str, debugger: list[str]) -> bool:
-	"""Ping the domain and score it."""
-	# We convert the float to integer in order to get rid of the decimal
-	# From there we convert it to a string so we can prefix zeros for sorting
-	res = str(int(ping(domain, count=4, match=True, timeout=1).rtt_avg_ms))
-	debugger.append(f'Ping ms: {res}')
-	if len(res) == 2:
-		res = '0'+res
-	elif len(res) == 1:
-		res = '00'+res
-	elif len(res) > 3:
-		debugger.append('Mirror too slow')
-		dprint(debugger)
-		return False
-
-	debugger.append(f'Appended: {res} {mirror}')
-	dprint(debugger)
-	netselect_scored.append(f'{res} {mirror}')
-	return True
-
-def ping_progress(live: Live, task: TaskID, total: int, num: int) -> None:
+	# apt refuses a release past its Valid-Until
+	valid_until = release_time(fields.get('Valid-Until', ''))
+	if valid_until and valid_until < time():
+		probe.error = 'Release has expired'
+
+def check_lag(probes: list[MirrorProbe]) -> None:
+	"""Set an error on the probes that are too far behind the newest mirror."""
+	newest = max((probe.date for probe in probes if not probe.error), default=0)
+	for probe in probes:
+		if probe.error or not probe.date or newest - probe.date <= MAX_LAG:
+			continue
+		probe.error = f'{(newest - probe.date) / 3600:.0f} hours behind the newest mirror'
+		dprint(probe)
+		probe_error(probe)
+
+async def probe_mirrors(mirrors: list[str], release: str,
+	wanted: int, arches: tuple[str, ...]) -> list[MirrorProbe]:
+	"""Probe mirrors in waves until the fastest wanted are unlikely to change.
+
+	mirrors should be ordered by how fast we expect them to be. Returns every probe we ran.
+	"""
+	probes: list[MirrorProbe] = []
+	with Live(transient=True) as live:
+		task = fetch_progress.add_task('', total=len(mirrors))
+		# Every connection is to a different mirror, there's nothing to keep alive
+		async with AsyncClient(
+			follow_redirects=True, timeout=Timeout(PROBE_TIMEOUT),
+			limits=Limits(max_connections=PROBE_CONCURRENCY, max_keepalive_connections=0),
+		) as client:
+
+			async def run_probe(mirror: str) -> None:
+				probe = await probe_mirror(client, mirror, release, arches)
+				probes.append(probe)
+				dprint(probe)
+				if probe.error:
+					probe_error(probe)
+				probe_progress(live, task, len(mirrors), len(probes))
+
+			cutoff = float('inf')
+			for start in range(0, len(mirrors), PROBE_CONCURRENCY):
+				wave = mirrors[start:start+PROBE_CONCURRENCY]
+				await asyncio.gather(*(run_probe(mirror) for mirror in wave))
+				# A newer mirror in this wave can leave earlier ones behind
+				check_lag(probes)
+				scores = sorted(probe.score() for probe in probes)
+				if PROBE_ALL or len(scores) < wanted or scores[wanted-1] == float('inf'):
+					continue
+				# The rest had a worse prior than this wave, they won't do much better
+				if scores[wanted-1] > cutoff * WAVE_GAIN:
+					dprint(f'Stopping after {len(probes)} probes, cutoff {scores[wanted-1]:.3f}')
+					break
+				cutoff = scores[wanted-1]
+	return probes
+
+def local_country() -> str:
+	"""Return the country we're in, going by the locale."""
+	if arguments.country:
+		return str(arguments.country.upper())
+	for var in ('LC_ALL', 'LC_MESSAGES', 'LANG'):
+		if value := os.environ.get(var):
+			if result := LOCALE_COUNTRY.match(value):
+				return result.group(1)
+			return ''
+	return ''
+
+def probe_order(sites: list[MirrorSite], previous: dict[str, float]) -> list[MirrorSite]:
+	"""Order sites by how fast we expect them to be.
+
+	Mirrors that did well last time come first, then ones in our country, then bandwidth.
+	"""
+	country = local_country()
+	return sorted(sites, key=lambda site: (
+		site.url not in previous, previous.get(site.url, 0),
+		country not in site.countries, -site.bandwidth,
+	))
+
+def load_scores() -> dict[str, float]:
+	"""Return the scores of the mirrors we probed last time."""
+	try:
+		scores = json.loads(FETCH_SCORES.read_text(encoding='utf-8'))
+	except (OSError, ValueError):
+		return {}
+	return scores if isinstance(scores, dict) else {}
+
+def save_scores(scores: dict[str, float], probes: list[MirrorProbe]) -> None:
+	"""Remember how the mirrors we probed did for next time."""
+	for probe in probes:
+		if probe.error:
+			scores.pop(probe.mirror, None)
+		else:
+			scores[probe.mirror] = round(probe.score(), 4)
+	tmp = FETCH_SCORES.with_suffix('.tmp')
+	try:
+		FETCH_SCORES.parent.mkdir(parents=True, exist_ok=True)
+		tmp.write_text(json.dumps(scores), encoding='utf-8')
+		tmp.replace(FETCH_SCORES)
+	except OSError as err:
+		dprint(f"Failed to write {FETCH_SCORES}: {err}")
+
+def probe_progress(live: Live, task: TaskID, total: int, num: int) -> None:
 	"""Update fetch progress bar."""
 	if not arguments.debug:
 		table = Table.grid()
@@ -100,27 +360,23 @@ def ping_progress(live: Live, task: TaskID, total: int, num: int) -> None:
 		fetch_progress.advance(task)
 		live.update(table)
 
-def ping_error(err: str, domain: str, mirror: str) -> None:
-	"""Handle error on ping."""
+def probe_error(probe: MirrorProbe) -> None:
+	"""Print why a mirror couldn't be probed."""
 	if arguments.verbose:
-		# socket.gaierror: [Errno -2] Name or service not known
-		if 'Errno' in err:
+		# [Errno -2] Name or service not known
+		if 'Errno' in probe.error:
 			print(
-				f"{color(re.sub(ERRNO_PATTERN, '', err), 'YELLOW')}: {domain}",
-				f"{color('URL:', 'YELLOW')} {mirror}\n"
+				f"{color(re.sub(ERRNO_PATTERN, '', probe.error).strip(), 'YELLOW')}: "
+				f"{URL(probe.mirror).host}",
+				f"{color('URL:', 'YELLOW')} {probe.mirror}\n"
 			)
 			return
-		# 'Cannot resolve address "mirror.telepoint.bg", try verify your DNS or host file'
-		if err.startswith('Cannot resolve'):
-			print(f"{color('Warning:', 'YELLOW')} {str(err).split(',', maxsplit=1)[0]}")
-			return
-		print(err)
+		print(f"{color('Warning:', 'YELLOW')} {probe.mirror} {probe.error}")
 
-def ubuntu_mirror(country_list: tuple[str, ...] | None) -> tuple[str, ...]:
+def ubuntu_mirror(country_list: tuple[str, ...] | None) -> tuple[MirrorSite, ...]:
 	"""Get and parse the Ubuntu mirror list."""
 	print('Fetching Ubuntu mirrors...')
-	ubuntu = fetch_mirrors("https://launchpad.net/ubuntu/+archivemirrors-rss", '<item>')
-	# This is what one of our "Mirrors might look like after split"
+	# This is what one of the records looks like
 	#      <title>Steadfast Networks</title>
 	#      <link>http://mirror.steadfastnet.com/ubuntu/</link>
 	#      <description>
@@ -134,14 +390,14 @@ def ubuntu_mirror(country_list: tuple[str, ...] | None) -> tuple[str, ...]:
 	#      <pubDate>Fri, 24 Dec 2021 05:26:30 -0000</pubDate>
 	#      <guid>http://mirror.steadfastnet.com/ubuntu/</guid>
 	#    </item>
-	return parse_mirror(UBUNTU, ubuntu, country_list)
+	return fetch_mirrors(
+		UBUNTU, "https://launchpad.net/ubuntu/+archivemirrors-rss", ubuntu_parser
+	).select(country_list)
 
-def debian_mirror(country_list: tuple[str, ...] | None) -> tuple[str, ...]:
+def debian_mirror(country_list: tuple[str, ...] | None) -> tuple[MirrorSite, ...]:
 	"""Get and parse the Debian mirror list."""
 	print('Fetching Debian mirrors...')
-	debian = fetch_mirrors("https://mirror-master.debian.org/status/Mirrors.masterlist", '\n\n')
-	arches = tuple(get_architectures())
-	# This is what one of our "Mirrors might look like after split"
+	# This is what one of the records looks like
 	# Site: mirrors.edge.kernel.org
 	# Country: NL Netherlands
 	# Country: US United States
@@ -151,80 +407,128 @@ def debian_mirror(country_list: tuple[str, ...] | None) -> tuple[str, ...]:
 	# Archive-architecture: amd64 arm64 armel armhf i386 mips mips64el mipsel powerpc ppc64el s390x
 	# Archive-http: /debian/
 	# Sponsor: packet.net https://packet.net/
-	return parse_mirror(DEBIAN, debian, country_list, arches)
+	return fetch_mirrors(
+		DEBIAN, "https://mirror-master.debian.org/status/Mirrors.masterlist", debian_parser
+	).select(country_list, tuple(get_architectures()))
 
-def fetch_mirrors(url: str, splitter: str) -> tuple[str, ...]:
-	"""Attempt to fetch the url and split a list based on the splitter."""
+def fetch_mirrors(distro: str, url: str,
+	list_parser: Callable[[Iterable[str]], Iterator[MirrorSite]]) -> MirrorList:
+	"""Return every mirror on the master list at url.
+
+	The list and what we parsed from it are kept in MASTER_LISTS, and only
+	downloaded again if the server says it changed. If we can't reach it the copy we have is used.
+	"""
+	raw = MASTER_LISTS / f'{distro.lower()}.txt'
+	parsed = MASTER_LISTS / f'{distro.lower()}.json'
+	try:
+		cache = json.loads(parsed.read_text(encoding='utf-8')) if raw.exists() else {}
+	except (OSError, ValueError):
+		cache = {}
+	headers = {}
+	if etag := cache.get('etag'):
+		headers['If-None-Match'] = etag
+	if last_modified := cache.get('last_modified'):
+		headers['If-Modified-Since'] = last_modified
+
+	text = None
 	try:
-		mirror_list = get(url, timeout=15).text.split(splitter)
-	except HTTPError:
-		sys.exit(ERROR_PREFIX+f'unable to connect to {url}')
-	return tuple(mirror_list)
-
-def parse_mirror(
-		distro: str, master_mirror: tuple[str, ...],
-		country_list: tuple[str, ...] | None,
-		arches: tuple[str, ...] | tuple[()] = ()
-	) -> tuple[str, ...]:
-	"""Parse the mirror."""
-	mirror_set = set()
+		response = get(url, timeout=15, headers=headers)
+		if response.status_code == 304:
+			dprint(f'{url} has not changed')
+		else:
+			response.raise_for_status()
+			text = response.text
+			cache = {
+				'etag': response.headers.get('etag', ''),
+				'last_modified': response.headers.get('last-modified', ''),
+			}
+	except HTTPError as error:
+		if not raw.exists():
+			sys.exit(ERROR_PREFIX+f'unable to connect to {url}')
+		dprint(error)
+		print(
+			f"{color('Warning:', 'YELLOW')} unable to connect to {url}, using the list from {raw}"
+		)
+
+	if text is None and 'records' in cache:
+		return MirrorList([MirrorSite.load(site) for site in cache['records']])
+	if text is None:
+		text = raw.read_text(encoding='utf-8')
 	if arguments.verbose:
 		print('Parsing mirror list...')
-	# If no country is supplied then our list will be all countries
-	countries = country_list or get_countries(master_mirror)
-	for country, mirror in itertools.product(countries, master_mirror):
-		if country not in mirror:
+	sites = list(list_parser(io.StringIO(text)))
+	cache['records'] = [site.dump() for site in sites]
+	try:
+		# nala fetch can be the first thing run on a new machine
+		MASTER_LISTS.mkdir(parents=True, exist_ok=True)
+		raw.write_text(text, encoding='utf-8')
+		parsed.write_text(json.dumps(cache), encoding='utf-8')
+	except OSError as err:
+		dprint(f"Failed to write {MASTER_LISTS}: {err}")
+	return MirrorList(sites)
+
+def debian_parser(lines: Iterable[str]) -> Iterator[MirrorSite]:
+	"""Parse Mirrors.masterlist a line at a time, records end at a blank line."""
+	fields: dict[str, list[str]] = {}
+	for line in itertools.chain(lines, ('',)):
+		if not line.strip():
+			if 'Site' in fields:
+				yield debian_site(fields)
+			fields = {}
+		# Continuation lines are only ever in the comments
+		elif not line[0].isspace():
+			key, _, value = line.partition(':')
+			fields.setdefault(key, []).append(value.strip())
+
+def debian_site(fields: dict[str, list[str]]) -> MirrorSite:
+	"""Make a mirror out of the fields of a masterlist record."""
+	# Site: mirrors.edge.kernel.org
+	site = MirrorSite(fields['Site'][0])
+	# Country: NL Netherlands
+	site.countries = {value.split()[0] for value in fields.get('Country', ()) if value}
+	# Archive-architecture: amd64 arm64 armel armhf i386
+	site.arches = {
+		arch for value in fields.get('Archive-architecture', ()) for arch in value.split()
+	}
+	# Archive-http: /debian/
+	site.protocols = {
+		protocol for protocol in DEBIAN_PROTOCOLS if f'Archive-{protocol}' in fields
+	}
+	if 'Archive-http' in fields:
+		site.url = f"http://{site.site}{fields['Archive-http'][0]}"
+	return site
+
+def ubuntu_parser(lines: Iterable[str]) -> Iterator[MirrorSite]:
+	"""Parse the archive mirrors RSS a line at a time, records are each <item>."""
+	site = None
+	for line in lines:
+		if '<item>' in line:
+			site = MirrorSite('')
+		# Everything before the first item describes the feed
+		elif site is None:
 			continue
-		if distro == DEBIAN:
-			url = debian_parser(mirror, arches)
-		elif distro == UBUNTU:
-			url = ubuntu_parser(mirror)
-
-		if url:
-			mirror_set.add(url)
-	return tuple(mirror_set)
-
-def get_countries(master_mirror: tuple[str, ...]) -> tuple[str, ...]:
-	"""Iterate the mirror list and return all valid countries."""
-	country_list = set()
-	# The way we split the information we get nice and pretty mirror selections
-	for mirror in master_mirror:
-		for line in mirror.splitlines():
-			# Debian Countries
-			if 'Country:' in line:
-				# Country: SE Sweden
-				country_list.add(line.split()[1])
-			# Ubuntu Countries
-			elif '<mirror:countrycode>' in line:
-				# <mirror:countrycode>US</mirror:countrycode>
-				if result := re.search(UBUNTU_COUNTRY, line):
-					country_list.add(result.group(1))
-	return tuple(country_list)
-
-def debian_parser(mirror: str, arches: tuple[str, ...] | tuple[()]) -> str | None:
-	"""Parse the Debian mirror."""
-	url = 'http://'
-	if 'Archive-http:' in mirror and all(arch in mirror for arch in arches):
-		for line in mirror.splitlines():
-			if line.startswith(('Archive-http:', 'Site:')):
-				#['Site:', 'mirror.steadfastnet.com']
-				#['Archive-http:', '/debian/']
-				url += line.split()[1]
-	if url == 'http://':
-		return None
-	return url
-
-def ubuntu_parser(mirror: str) -> str | None:
-	"""Parse the Ubuntu mirror."""
-	# First section we get from Ubuntu is garbage. Let's ditch it and get to business
-	if '<title>Ubuntu Archive Mirrors Status</title>' in mirror:
-		return None
-
-	for line in mirror.splitlines():
-		# <link>http://mirror.steadfastnet.com/ubuntu/</link>
-		if result := re.search(UBUNTU_MIRROR, line):
-			return result.group(1)
-	return None
+		elif '</item>' in line:
+			if site.site:
+				yield site
+			site = None
+		elif result := UBUNTU_FIELD.search(line):
+			ubuntu_field(site, *result.groups())
+
+def ubuntu_field(site: MirrorSite, field: str, value: str) -> None:
+	"""Fill in the site from a field of its RSS item."""
+	# <link>http://mirror.steadfastnet.com/ubuntu/</link>
+	if field == 'link':
+		link = urlsplit(value)
+		site.site = link.hostname or ''
+		site.protocols.add(link.scheme)
+		if link.scheme in ('http', 'https') and not site.url.startswith('http:'):
+			site.url = value
+	# <mirror:countrycode>US</mirror:countrycode>
+	elif field == 'mirror:countrycode':
+		site.countries.add(value)
+	# <mirror:bandwidth>80</mirror:bandwidth>
+	elif value.isdigit():
+		site.bandwidth = int(value)
 
 def detect_release() -> tuple[str, str]:
 	"""Detect the distro and release."""
@@ -250,15 +554,15 @@ def parse_sources() -> list[str]:
 				sources.append(line)
 	return sources
 
-def write_sources(release: str, component: str, sources: list[str]) -> None:
+def write_sources(release: str, component: str,
+	sources: list[str], probes: list[MirrorProbe]) -> None:
 	"""Write mirrors to nala-sources.list."""
 	with open(NALA_SOURCES, 'w', encoding="utf-8") as file:
 		print(f"{color('Writing:', 'GREEN')} {NALA_SOURCES}\n")
 		print('# Sources file built for nala\n', file=file)
 		num = 0
-		for line in netselect_scored:
-			# This splits off the score '030 http://mirror.steadfast.net/debian/'
-			line = line[line.index('h'):]
+		for probe in probes:
+			line = probe.mirror
 			# This protects us from writing mirrors that we already have in the sources
 			if any(line in mirror and release in mirror for mirror in sources):
 				continue
@@ -271,19 +575,24 @@ def write_sources(release: str, component: str, sources: list[str]) -> None:
 			if num == arguments.fetches:
 				break
 
-def test_mirrors(netselect: tuple[str, ...]) -> None:
-	"""Test mirrors."""
+def test_mirrors(netselect: list[MirrorSite], release: str) -> list[MirrorProbe]:
+	"""Test mirrors and return the ones that answered, fastest first."""
 	print('Testing mirrors...')
-	with Live(transient=True) as live:
-		with ThreadPoolExecutor(max_workers=32) as pool:
-			total = len(netselect)
-			task = fetch_progress.add_task('', total=total)
-
-			for num, mirror in enumerate(netselect):
-				pool.submit(net_select, mirror, task, live, total, num)
+	scores = load_scores()
+	order = [site.url for site in probe_order(netselect, scores)]
+	probes = asyncio.run(
+		probe_mirrors(order, release, arguments.fetches, tuple(get_architectures()))
+	)
+	if saved := len(order) - len(probes):
+		print(
+			f"{color('Probed:', 'GREEN')} {len(probes)} of {len(order)} mirrors, "
+			f"{saved} probes saved"
+		)
+	save_scores(scores, probes)
+	return sorted((probe for probe in probes if not probe.error), key=MirrorProbe.score)
 
 def check_supported(distro:str, release:str,
-	country_list: tuple[str, ...] | None) -> tuple[tuple[str, ...], str]:
+	country_list: tuple[str, ...] | None) -> tuple[tuple[MirrorSite, ...], str]:
 	"""Check if the distro is supported or not.
 
 	If the distro is supported return mirror list and component.
@@ -326,12 +635,15 @@ def fetch() -> None:
 	dprint(netselect)
 	dprint(f'Distro: {distro}, Release: {release}, Component: {component}')
 
-	test_mirrors(netselect)
-	netselect_scored.sort()
+	sources = parse_sources()
+	# Mirrors we already have won't be written, so there's no point testing them
+	candidates = [
+		site for site in netselect
+		if not any(site.url in mirror and release in mirror for mirror in sources)
+	]
+	probes = test_mirrors(candidates, release)
 
-	dprint(netselect_scored)
 	dprint(f'Size of original list: {len(netselect)}')
-	dprint(f'Size of scored list: {len(netselect_scored)}')
-	dprint(f'Writing from: {netselect_scored[:arguments.fetches]}')
-	sources = parse_sources()
-	write_sources(release, component, sources)
+	dprint(f'Size of scored list: {len(probes)}')
+	dprint(f'Writing from: {probes[:arguments.fetches]}')
+	write_sources(release, component, sources, probes)
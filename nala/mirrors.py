@@ -0,0 +1,340 @@
+#                 __
+#    ____ _____  |  | _____
+#   /    \\__  \ |  | \__  \
+#  |   |  \/ __ \|  |__/ __ \_
+#  |___|  (____  /____(____  /
+#       \/     \/          \/
+#
+# Copyright (C) 2021, 2022 Blake Lee
+#
+# This file is part of nala
+#
+# nala is program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# nala is program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with nala.  If not, see <https://www.gnu.org/licenses/>.
+"""Score mirrors, find the lists behind mirror:// and the proxies to reach them."""
+from __future__ import annotations
+
+import asyncio
+import json
+import sys
+from asyncio import gather
+from random import random
+from time import monotonic, time
+from typing import TypedDict
+
+import apt_pkg
+from httpx import URL, AsyncClient, HTTPError, HTTPStatusError, TransportError
+
+from nala.constants import ERROR_PREFIX, MIRROR_LISTS
+from nala.utils import color, dprint, unit_str, vprint
+
+# Seconds a mirror:// list is used before asking its domain if it has changed
+MIRROR_LIST_TTL = apt_pkg.config.find_i('Nala::Download::Mirror-List-TTL', 86400)
+# Seconds to wait on a mirror, Acquire::http::Timeout can also be set per host
+TIMEOUT = 20
+# Seconds to wait on an auto detected proxy before giving up on it
+PROXY_CONNECT_TIMEOUT = 3
+# Chance that a package is sent to a mirror other than the best one, to keep scores fresh
+EXPLORE_RATE = 0.1
+# Failures in a row before a mirror is skipped, and the seconds before it's tried again
+BREAKER_THRESHOLD = max(apt_pkg.config.find_i('Nala::Download::Breaker-Threshold', 3), 1)
+BREAKER_COOLDOWN = apt_pkg.config.find_i('Nala::Download::Breaker-Cooldown', 30)
+
+class MirrorScore: # pylint: disable=too-many-instance-attributes
+	"""Throughput, latency and errors of a single mirror during this run."""
+
+	def __init__(self) -> None:
+		"""Throughput, latency and errors of a single mirror during this run."""
+		self.data: int = 0
+		self.seconds: float = 0
+		self.first_byte: float = 0
+		self.requests: int = 0
+		self.errors: int = 0
+		# Circuit breaker, opened is when it tripped and 0 while closed
+		self.failures: int = 0
+		self.opened: float = 0
+		self.probing = False
+
+	def __repr__(self) -> str:
+		"""Represent the mirror score as a string."""
+		return (
+			f'MirrorScore(speed={unit_str(int(self.speed()), 0)}/s, '
+			f'ttfb={self.ttfb():.3f}s, requests={self.requests}, errors={self.errors}, '
+			f'open={bool(self.opened)})'
+		)
+
+	def cooldown(self) -> float:
+		"""Return the seconds until this mirror may be tried again."""
+		if not self.opened or self.probing:
+			return 0
+		return max(self.opened + BREAKER_COOLDOWN - monotonic(), 0)
+
+	def tripped(self) -> bool:
+		"""Return True if requests to this mirror should be skipped."""
+		return bool(self.opened) and (
+			self.probing or monotonic() - self.opened < BREAKER_COOLDOWN
+		)
+
+	def speed(self) -> float:
+		"""Return the average bytes per second."""
+		return self.data / self.seconds if self.seconds else 0
+
+	def ttfb(self) -> float:
+		"""Return the average time to first byte."""
+		return self.first_byte / self.requests if self.requests else 0
+
+	def estimate(self, size: int) -> float:
+		"""Estimate the seconds it will take this mirror to send size bytes.
+
+		Mirrors we know nothing about estimate to 0 so they're tried first.
+		"""
+		if not (speed := self.speed()):
+			return 0 if not self.errors else float('inf')
+		return (self.ttfb() + size / speed) * (1 + self.errors)
+
+class MirrorScores:
+	"""Score mirrors by how they perform and pick the best for each package."""
+
+	def __init__(self) -> None:
+		"""Score mirrors by how they perform and pick the best for each package."""
+		self.mirrors: dict[str, MirrorScore] = {}
+
+	def __getitem__(self, url: str) -> MirrorScore:
+		"""Return the score of the host serving url."""
+		host = URL(url).host
+		if host not in self.mirrors:
+			self.mirrors[host] = MirrorScore()
+		return self.mirrors[host]
+
+	def first_byte(self, url: str, seconds: float) -> None:
+		"""Record the time it took url to start responding."""
+		score = self[url]
+		score.first_byte += seconds
+		score.requests += 1
+
+	def transfer(self, url: str, data: int, seconds: float) -> None:
+		"""Record a finished transfer from url."""
+		score = self[url]
+		score.data += data
+		score.seconds += seconds
+
+	def error(self, url: str, error: BaseException | None = None) -> None:
+		"""Record a failed transfer from url.
+
+		Errors that are the mirror's fault count toward opening its breaker.
+		"""
+		score = self[url]
+		score.errors += 1
+		# Any response, even an error status, means the mirror is reachable
+		if error is None or isinstance(error, HTTPStatusError) and not mirror_fault(error):
+			self.success(url)
+			return
+		if not mirror_fault(error):
+			# We learned nothing about the mirror, the next request can probe it
+			score.probing = False
+			return
+		score.failures += 1
+		if score.probing or score.failures >= BREAKER_THRESHOLD:
+			if not score.opened or score.probing:
+				vprint(color('Mirror Unavailable: ', 'YELLOW') + str(URL(url).host))
+			score.opened = monotonic()
+			score.probing = False
+
+	def success(self, url: str) -> None:
+		"""Record that url answered, closing its breaker."""
+		score = self[url]
+		if score.opened:
+			vprint(color('Mirror Recovered: ', 'GREEN') + str(URL(url).host))
+		score.failures = 0
+		score.opened = 0
+		score.probing = False
+
+	def cancelled(self, url: str) -> None:
+		"""Record that a request to url was cancelled before it was answered."""
+		self[url].probing = False
+
+	def allow(self, url: str) -> bool:
+		"""Return True if a request may go to url.
+
+		Once the cool-down is over the first caller gets through as a probe.
+		"""
+		score = self[url]
+		if score.tripped():
+			return False
+		if score.opened:
+			score.probing = True
+		return True
+
+	def order(self, urls: list[str], size: int) -> list[str]:
+		"""Return urls with the mirror expected to finish size bytes first at the front.
+
+		Every so often a random mirror is put first instead so its score stays fresh.
+		"""
+		ordered = sorted(urls, key=lambda url: self[url].estimate(size))
+		if len(ordered) > 1 and random() < EXPLORE_RATE:
+			ordered.insert(0, ordered.pop(int(random() * (len(ordered) - 1)) + 1))
+		return ordered
+
+class ProxyDetector:
+	"""Ask apt's Proxy-Auto-Detect helper which proxy each host should use."""
+
+	def __init__(self) -> None:
+		"""Ask apt's Proxy-Auto-Detect helper which proxy each host should use."""
+		# Each proxy the helpers hand out is only checked once
+		self.reachable: dict[str, bool] = {}
+
+	async def detect(self, url: str, helper: str) -> str | None:
+		"""Return the proxy helper picks for url, DIRECT to connect directly.
+
+		None means there was no usable answer, and apt's configured proxy still applies.
+		"""
+		parsed = URL(url)
+		answer = ''
+		process = None
+		try:
+			# apt passes the url and reads the proxy from the first line
+			process = await asyncio.create_subprocess_exec(
+				helper, url, stdout=asyncio.subprocess.PIPE
+			)
+			output, _err = await asyncio.wait_for(process.communicate(), acquire_timeout(url))
+			answer = output.decode().strip().split('\n')[0].strip()
+		except (OSError, asyncio.TimeoutError) as error:
+			vprint(f"{ERROR_PREFIX}{helper} {error or 'timed out'}")
+			if process and process.returncode is None:
+				process.kill()
+				await process.wait()
+		proxy: str | None = answer or None
+		if answer.upper() == 'DIRECT':
+			proxy = 'DIRECT'
+		elif proxy and not await self.is_reachable(proxy):
+			vprint(color('Proxy Unreachable: ', 'YELLOW') + f"{proxy}, not using it for {parsed.host}")
+			proxy = None
+		dprint(f'Proxy for {parsed.scheme}://{parsed.host}: {proxy or "no answer"}')
+		return proxy
+
+	async def is_reachable(self, proxy: str) -> bool:
+		"""Return True if we can open a connection to proxy."""
+		if proxy not in self.reachable:
+			parsed = URL(proxy)
+			try:
+				_reader, writer = await asyncio.wait_for(
+					asyncio.open_connection(parsed.host, parsed.port or 80), PROXY_CONNECT_TIMEOUT
+				)
+				writer.close()
+				self.reachable[proxy] = True
+			except (OSError, asyncio.TimeoutError):
+				self.reachable[proxy] = False
+		return self.reachable[proxy]
+
+class MirrorListEntry(TypedDict):
+	"""A mirror list cached in MIRROR_LISTS."""
+
+	mirrors: list[str]
+	etag: str
+	last_modified: str
+	fetched: float
+
+class MirrorLists:
+	"""The mirrors.txt of each mirror:// domain, cached on disk between runs."""
+
+	def __init__(self) -> None:
+		"""The mirrors.txt of each mirror:// domain, cached on disk between runs."""
+		self.changed = False
+		try:
+			entries = json.loads(MIRROR_LISTS.read_text(encoding='utf-8'))
+			self.entries: dict[str, MirrorListEntry] = (
+				entries if isinstance(entries, dict) else {}
+			)
+		except (OSError, ValueError):
+			self.entries = {}
+
+	async def resolve(self, client: AsyncClient, domains: list[str]) -> dict[str, list[str]]:
+		"""Return the mirrors of every domain, fetching the lists at the same time."""
+		lists = await gather(*(self.fetch(client, domain) for domain in domains))
+		self.save()
+		return dict(zip(domains, lists))
+
+	async def fetch(self, client: AsyncClient, domain: str) -> list[str]:
+		"""Return the mirrors of domain.
+
+		A cached list is used until it's older than MIRROR_LIST_TTL, then it's revalidated.
+		If the domain can't be reached a stale list is better than none.
+		"""
+		url = f"http://{domain}/mirrors.txt"
+		entry = self.entries.get(domain)
+		if entry and time() - entry['fetched'] < MIRROR_LIST_TTL:
+			return list(entry['mirrors'])
+		headers = {}
+		if entry and entry['etag']:
+			headers['If-None-Match'] = entry['etag']
+		if entry and entry['last_modified']:
+			headers['If-Modified-Since'] = entry['last_modified']
+		try:
+			response = await client.get(url, headers=headers)
+			if response.status_code == 304 and entry:
+				dprint(f'{url} has not changed')
+			else:
+				response.raise_for_status()
+				entry = {
+					'mirrors': [line for line in response.text.split() if line],
+					'etag': response.headers.get('etag', ''),
+					'last_modified': response.headers.get('last-modified', ''),
+					'fetched': 0.0,
+				}
+		except HTTPError as error:
+			if not entry:
+				sys.exit(ERROR_PREFIX+f'unable to connect to {url}')
+			vprint(f"{ERROR_PREFIX}{url} {error}, using the cached list")
+			return list(entry['mirrors'])
+		entry['fetched'] = time()
+		self.entries[domain] = entry
+		self.changed = True
+		return list(entry['mirrors'])
+
+	def save(self) -> None:
+		"""Write the lists we fetched."""
+		if not self.changed:
+			return
+		tmp = MIRROR_LISTS.with_suffix('.tmp')
+		try:
+			tmp.write_text(json.dumps(self.entries), encoding='utf-8')
+			tmp.replace(MIRROR_LISTS)
+		except OSError as err:
+			dprint(f"Failed to write {MIRROR_LISTS}: {err}")
+			return
+		self.changed = False
+
+def mirror_fault(error: BaseException) -> bool:
+	"""Return True if error means the mirror or the network to it is struggling."""
+	return isinstance(error, TransportError) or (
+		isinstance(error, HTTPStatusError)
+		and (error.response.status_code >= 500 or error.response.status_code == 429)
+	)
+
+def acquire_key(url: str, option: str) -> str | None:
+	"""Return the key apt would read the Acquire option for url from, if it's set.
+
+	Like apt a value for the host wins, and https falls back to the http settings.
+	"""
+	parsed = URL(url)
+	for scheme in dict.fromkeys((parsed.scheme, 'http')):
+		for key in (f'Acquire::{scheme}::{option}::{parsed.host}', f'Acquire::{scheme}::{option}'):
+			if apt_pkg.config.exists(key):
+				return key
+	return None
+
+def acquire_timeout(url: str) -> float:
+	"""Return the seconds to wait on url from Acquire::http::Timeout."""
+	if key := acquire_key(url, 'Timeout'):
+		return max(apt_pkg.config.find_i(key), 1)
+	return TIMEOUT
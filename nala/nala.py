@@ -41,17 +41,17 @@ from apt.package import Package
 
 from nala.constants import (ARCHIVE_DIR, DPKG_LOG,
 				ERROR_PREFIX, NALA_DIR, PARTIAL_DIR, ExitCode)
-from nala.downloader import PkgDownloader
+from nala.downloader import PkgDownloader, apt_fallback
 from nala.dpkg import InstallProgress, OpProgress, UpdateProgress, notice
 from nala.history import write_history, write_log
 from nala.install import (broken_error, check_broken,
 				install_local, package_manager, split_local)
 from nala.options import arguments
+from nala.pipeline import PIPELINE, Pipeline, pipeline_ops
 from nala.rich import Columns, Live, Table, Text, console, dpkg_progress
 from nala.show import additional_notice, check_virtual, show
-from nala.utils import (DelayedKeyboardInterrupt, ask,
-				check_pkg, color, dprint, get_pkg_name, pkg_candidate,
-				pkg_installed, print_packages, term, unit_str)
+from nala.utils import (DelayedKeyboardInterrupt, ask, color, dprint,
+				get_pkg_name, pkg_candidate, pkg_installed, print_packages, term, unit_str)
 
 
 class Nala:
@@ -182,22 +182,31 @@ class Nala:
 				+ len(install_names)*2
 				+ len(upgrade_names)*2
 			)
-			pkgs = [
-				# Don't download packages that already exist
-				pkg for pkg in pkgs if not pkg.marked_delete and not check_pkg(ARCHIVE_DIR, pkg)
-			]
-
-		download(pkgs)
+			# Archives that are already cached get verified by the downloader
+			pkgs = [pkg for pkg in pkgs if not pkg.marked_delete]
+
+		# Local debs go through dpkg -i afterwards, so only pipeline plain transactions
+		ops: list[tuple[str, str]] = []
+		if PIPELINE and pkgs and not arguments.download_only:
+			if self.local_debs:
+				print(color('Not Pipelining: ', 'YELLOW') + 'local .deb files are installed afterwards')
+			else:
+				ops = pipeline_ops(self.cache)
+		if not ops:
+			download(pkgs)
 
 		write_history(delete_names+autoremove_names, install_names, upgrade_names)
 		write_log(delete_names, install_names, upgrade_names, autoremove_names)
-		self.start_dpkg(pkg_total)
+		self.start_dpkg(pkg_total, Pipeline(pkgs, ops) if ops else None)
+
+	def start_dpkg(self, pkg_total: int, pipeline: Pipeline | None = None) -> None:
+		"""Set environment and start dpkg.
 
-	def start_dpkg(self, pkg_total: int) -> None:
-		"""Set environment and start dpkg."""
+		With a pipeline the rest of the packages are downloaded while dpkg is running.
+		"""
 		set_env()
 		try:
-			self.commit_pkgs(pkg_total)
+			self.commit_pkgs(pkg_total, pipeline)
 		# Catch system error because if dpkg fails it'll throw this
 		except (apt_pkg.Error, SystemError) as error:
 			sys.exit(f'\r\n{ERROR_PREFIX + str(error)}')
@@ -218,7 +227,7 @@ class Nala:
 					print(notice_msg)
 		print(color("Finished Successfully", 'GREEN'))
 
-	def commit_pkgs(self, pkg_total: int) -> None:
+	def commit_pkgs(self, pkg_total: int, pipeline: Pipeline | None) -> None:
 		"""Commit the package changes to the cache."""
 		if self.local_debs:
 			# Add one because we start a new instance of InstallProgress
@@ -229,6 +238,8 @@ class Nala:
 			with open(DPKG_LOG, 'w', encoding="utf-8") as dpkg_log:
 				if arguments.raw_dpkg:
 					live.stop()
+				if pipeline and pipeline.install(InstallProgress(dpkg_log, live, task)):
+					return
 				self.cache.commit(
 					UpdateProgress(live, install=True),
 					InstallProgress(dpkg_log, live, task)
@@ -491,7 +502,7 @@ def download(pkgs: list[Package]) -> None:
 		sys.exit(0)
 
 	if downloader.failed:
-		print("Some downloads failed. Falling back to apt_pkg.")
+		apt_fallback(downloader.failed)
 
 def glob_filter(pkg_names: list[str], cache_keys: list[str]) -> list[str]:
 	"""Filter provided packages and glob *.
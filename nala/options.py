@@ -302,7 +302,7 @@ remove_help_options(
 fetch_parser = subparsers.add_parser('fetch',
 	formatter_class=formatter,
 	description=(
-	'Nala will fetch mirrors with the lowest latency.\n'
+	'Nala will fetch the mirrors that answer and send files the fastest.\n'
 	'For Debian https://mirror-master.debian.org/status/Mirrors.masterlist\n'
 	'For Ubuntu https://launchpad.net/ubuntu/+archivemirrors-rss'
 	),
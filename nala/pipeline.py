@@ -0,0 +1,316 @@
+#                 __
+#    ____ _____  |  | _____
+#   /    \\__  \ |  | \__  \
+#  |   |  \/ __ \|  |__/ __ \_
+#  |___|  (____  /____(____  /
+#       \/     \/          \/
+#
+# Copyright (C) 2021, 2022 Blake Lee
+#
+# This file is part of nala
+#
+# nala is program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# nala is program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with nala.  If not, see <https://www.gnu.org/licenses/>.
+"""Unpack packages with dpkg while the rest are still downloading."""
+from __future__ import annotations
+
+import os
+import signal
+import subprocess
+from asyncio import run
+from functools import partial
+from itertools import groupby, takewhile
+from pathlib import Path
+from select import select
+from typing import TYPE_CHECKING
+
+import apt_pkg
+from apt.cache import Cache
+from apt.package import Package
+
+from nala.constants import ARCHIVE_DIR, ERROR_PREFIX
+from nala.downloader import PkgDownloader, apt_fallback
+from nala.options import arguments
+from nala.utils import color, dprint, get_pkg_name, pkg_candidate, term
+
+if TYPE_CHECKING:
+	from nala.dpkg import InstallProgress
+
+# Opt in to unpacking while downloading
+PIPELINE = apt_pkg.config.find_b('Nala::Install::Pipeline', False)
+
+# Like apt, triggers wait for the configure --pending at the end
+NO_TRIGGERS = apt_pkg.config.find_b('DPkg::NoTriggers', True)
+CONFIGURE_PENDING = apt_pkg.config.find_b('DPkg::ConfigurePending', NO_TRIGGERS)
+
+def hook_version(command: str) -> int:
+	"""Return the version of the protocol apt speaks to a DPkg::Pre-Install-Pkgs hook.
+
+	apt looks it up under the first word of the command, 0 and 1 are a list of archives.
+	"""
+	return int(apt_pkg.config.find_i(f"DPkg::Tools::Options::{command.split(' ')[0]}::Version", 0))
+
+def transaction_hooks() -> list[str]:
+	"""Return the DPkg::Pre-Install-Pkgs hooks that need the whole transaction at once.
+
+	From version 2 on, hooks like apt-listchanges are told about every change before
+	anything is unpacked, so a transaction that has them can't be pipelined.
+	"""
+	return [
+		hook for hook in apt_pkg.config.value_list('DPkg::Pre-Install-Pkgs')
+		if hook_version(hook) > 1
+	]
+
+def pipeline_ops(cache: Cache) -> list[tuple[str, str]]:
+	"""Return apt's operations if the transaction can be pipelined, or say why it can't."""
+	if hooks := transaction_hooks():
+		print(
+			color('Not Pipelining: ', 'YELLOW')
+			+f"DPkg::Pre-Install-Pkgs hooks need the whole transaction, {', '.join(hooks)}"
+		)
+		return []
+	if not (ops := install_order(cache)):
+		print(color('Not Pipelining: ', 'YELLOW') + 'apt could not order the transaction')
+	return ops
+
+class OrderRecorder(apt_pkg.PackageManager): # type: ignore[misc]
+	"""Record the operations apt would hand to dpkg, in apt's order."""
+
+	def __init__(self, _depcache: apt_pkg.DepCache) -> None:
+		"""Record the operations apt would hand to dpkg, in apt's order."""
+		self.ops: list[tuple[str, str]] = []
+
+	def install(self, _pkg: apt_pkg.Package, filename: str) -> bool:
+		"""Record an unpack of the archive at filename."""
+		# Archives that aren't downloaded yet only have their name
+		self.ops.append(('unpack', str(ARCHIVE_DIR / Path(filename).name)))
+		return True
+
+	def configure(self, pkg: apt_pkg.Package) -> bool:
+		"""Record a configure of pkg."""
+		self.ops.append(('configure', pkg.get_fullname(True)))
+		return True
+
+	def remove(self, pkg: apt_pkg.Package, purge: bool) -> bool:
+		"""Record a removal of pkg."""
+		self.ops.append(('purge' if purge else 'remove', pkg.get_fullname(True)))
+		return True
+
+	def go(self, _status_fd: int) -> bool:
+		"""Don't run dpkg, we only wanted the order."""
+		return True
+
+	def reset(self) -> None:
+		"""Forget the recorded operations."""
+		self.ops.clear()
+
+class PipelineInstall:
+	"""Hand apt's operations to dpkg as soon as their archives are ready.
+
+	This runs in the child that InstallProgress forks, so its output is the dpkg output.
+	"""
+
+	def __init__(self, ops: list[tuple[str, str]], ready: set[str], ready_fd: int) -> None:
+		"""Hand apt's operations to dpkg as soon as their archives are ready."""
+		self.ops = ops
+		# Names of the archives that are verified and in the archive directory
+		self.ready = ready
+		self.ready_fd = ready_fd
+		self.downloading = True
+
+	def do_install(self) -> int:
+		"""Run the operations and return a PackageManager result."""
+		# We hold the frontend lock for dpkg, the same as apt does
+		os.environ['DPKG_FRONTEND_LOCKED'] = 'true'
+		if not run_hooks('DPkg::Pre-Invoke'):
+			return apt_pkg.PackageManager.RESULT_FAILED
+		res = self.run_ops()
+		if res != apt_pkg.PackageManager.RESULT_COMPLETED:
+			return res
+		if CONFIGURE_PENDING and not dpkg_action('configure', ['--pending']):
+			return apt_pkg.PackageManager.RESULT_FAILED
+		if not run_hooks('DPkg::Post-Invoke'):
+			return apt_pkg.PackageManager.RESULT_FAILED
+		return apt_pkg.PackageManager.RESULT_COMPLETED
+
+	def run_ops(self) -> int:
+		"""Hand the operations to dpkg, unpacking each batch once it's ready."""
+		for action, group in groupby(self.ops, key=lambda op: op[0]):
+			targets = [target for _action, target in group]
+			if action != 'unpack':
+				if not dpkg_action(action, targets):
+					return apt_pkg.PackageManager.RESULT_FAILED
+				continue
+			while targets:
+				batch = self.wait_ready(targets)
+				if not batch:
+					print(ERROR_PREFIX+f"{Path(targets[0]).name} was not downloaded")
+					return apt_pkg.PackageManager.RESULT_INCOMPLETE
+				# dpkg-preconfigure asks its questions before the batch is unpacked
+				hooks_input = ''.join(f'{path}\n' for path in batch)
+				if not run_hooks('DPkg::Pre-Install-Pkgs', hooks_input):
+					return apt_pkg.PackageManager.RESULT_FAILED
+				if not dpkg_action(action, batch):
+					return apt_pkg.PackageManager.RESULT_FAILED
+				targets = targets[len(batch):]
+		return apt_pkg.PackageManager.RESULT_COMPLETED
+
+	def wait_ready(self, paths: list[str]) -> list[str]:
+		"""Return the longest prefix of paths that is ready to unpack.
+
+		Blocks until at least one is ready, returns empty if the downloader gave up on it.
+		"""
+		prefix = self.ready_prefix(paths, block=False)
+		if not prefix and self.downloading:
+			print(color('Waiting for Download: ', 'YELLOW') + Path(paths[0]).name)
+			prefix = self.ready_prefix(paths, block=True)
+		return prefix
+
+	def ready_prefix(self, paths: list[str], block: bool) -> list[str]:
+		"""Read finished archives from the downloader and return the ready prefix."""
+		while True:
+			# Take everything already sent without waiting so batches are as large as they can be
+			while self.downloading and select([self.ready_fd], [], [], 0)[0]:
+				self.read_ready()
+			prefix = list(takewhile(lambda path: Path(path).name in self.ready, paths))
+			if prefix or not block or not self.downloading:
+				return prefix
+			self.read_ready()
+
+	def read_ready(self) -> None:
+		"""Block for the next message from the downloader."""
+		data = os.read(self.ready_fd, 4096)
+		if not data:
+			self.downloading = False
+			return
+		# Names are newline terminated and much shorter than the pipe buffer
+		self.ready.update(data.decode().split())
+
+def install_order(cache: Cache) -> list[tuple[str, str]]:
+	"""Return the operations apt will run, in the order it will run them."""
+	recorder = OrderRecorder(cache._depcache)
+	recorder.get_archives(apt_pkg.Acquire(), cache._list, cache._records)
+	if recorder.do_install(-1) != recorder.RESULT_COMPLETED:
+		return []
+	dprint(f"Install order: {recorder.ops}")
+	return recorder.ops
+
+class Pipeline: # pylint: disable=too-few-public-methods
+	"""Download packages in the background while dpkg installs the ones that are ready."""
+
+	def __init__(self, pkgs: list[Package], ops: list[tuple[str, str]]) -> None:
+		"""Start downloading pkgs in the order of ops, apt's operations from pipeline_ops.
+
+		Create this before any live display, the downloader forks from here.
+		"""
+		self.ops = ops
+		order = {
+			Path(target).name: num
+			for num, (action, target) in enumerate(self.ops) if action == 'unpack'
+		}
+		# Everything we aren't downloading was already checked in the archive
+		self.ready = set(order) - {get_pkg_name(pkg_candidate(pkg)) for pkg in pkgs}
+		self.read_fd, write_fd = os.pipe()
+		self.downloader = fork_downloader(pkgs, order, self.read_fd, write_fd)
+		os.close(write_fd)
+
+	def install(self, install_progress: InstallProgress) -> bool:
+		"""Run dpkg as the downloads finish.
+
+		Returns False if the downloads didn't finish and apt_pkg should complete the transaction.
+		"""
+		install_progress.start_update()
+		with apt_pkg.SystemLock():
+			# dpkg needs the inner lock, just like apt_pkg gives it up for commit
+			apt_pkg.pkgsystem_unlock_inner()
+			try:
+				res = install_progress.run(PipelineInstall(self.ops, self.ready, self.read_fd))
+			finally:
+				apt_pkg.pkgsystem_lock_inner()
+		install_progress.finish_update()
+		os.close(self.read_fd)
+
+		if res == apt_pkg.PackageManager.RESULT_FAILED:
+			os.kill(self.downloader, signal.SIGTERM)
+		_pid, status = os.waitpid(self.downloader, 0)
+		dprint(f"Pipeline result: {res}, downloader status: {status}")
+		if res == apt_pkg.PackageManager.RESULT_FAILED:
+			raise SystemError("installArchives() failed")
+		if res == apt_pkg.PackageManager.RESULT_COMPLETED:
+			return True
+		# The downloader's list died with it, what it fetched is in the archive
+		if missing := [
+			Path(target).name for action, target in self.ops
+			if action == 'unpack' and not Path(target).exists()
+		]:
+			apt_fallback(missing)
+		return False
+
+def fork_downloader(pkgs: list[Package], order: dict[str, int], read_fd: int, write_fd: int) -> int:
+	"""Fork a downloader that writes the name of each verified archive to write_fd."""
+	pid = os.fork()
+	if pid:
+		return pid
+	os.close(read_fd)
+	# The dpkg output owns the terminal, keep the download progress off of it
+	devnull = os.open(os.devnull, os.O_WRONLY)
+	os.dup2(devnull, term.STDOUT)
+	try:
+		downloader = PkgDownloader(pkgs, order, partial(send_ready, write_fd))
+		os._exit(0 if run(downloader.start_download()) else 1)
+	# Like the dpkg child we can't let anything escape back into nala
+	except BaseException: # pylint: disable=broad-except
+		os._exit(1)
+
+def send_ready(write_fd: int, name: str) -> None:
+	"""Tell the installer that an archive is ready."""
+	os.write(write_fd, f"{name}\n".encode())
+
+def dpkg_action(action: str, targets: list[str]) -> bool:
+	"""Run dpkg action on targets, return True if it succeeded."""
+	command = [
+		apt_pkg.config.find('Dir::Bin::dpkg', 'dpkg'),
+		*apt_pkg.config.value_list('DPkg::Options')
+	]
+	if action == 'unpack':
+		command += ['--unpack', '--auto-deconfigure']
+	elif action in ('remove', 'purge'):
+		# apt has already ordered around the depends, same as it does for itself
+		command.append('--force-depends')
+		if arguments.remove_essential:
+			command.append('--force-remove-essential')
+		command.append(f'--{action}')
+	else:
+		command.append('--configure')
+	if NO_TRIGGERS and action in ('unpack', 'configure') and targets != ['--pending']:
+		command.append('--no-triggers')
+	command += targets
+	dprint(f"Running: {command}")
+	# nosec because this isn't really a security issue. We're just running dpkg
+	return os.spawnvp(os.P_WAIT, command[0], command) == 0 # nosec
+
+def run_hooks(key: str, hooks_input: str | None = None) -> bool:
+	"""Run the commands apt would run for key, return False if one fails.
+
+	hooks_input is written to each of them, apt sends DPkg::Pre-Install-Pkgs the archives.
+	"""
+	for command in apt_pkg.config.value_list(key):
+		dprint(f"Running hook: {command}")
+		# nosec because these are the commands apt itself is configured to run
+		result = subprocess.run( # nosec
+			command, shell=True, check=False, input=hooks_input, text=True
+		)
+		if result.returncode:
+			print(ERROR_PREFIX+f"Sub-process {command} returned an error code")
+			return False
+	return True
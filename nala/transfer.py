@@ -0,0 +1,467 @@
+#                 __
+#    ____ _____  |  | _____
+#   /    \\__  \ |  | \__  \
+#  |   |  \/ __ \|  |__/ __ \_
+#  |___|  (____  /____(____  /
+#       \/     \/          \/
+#
+# Copyright (C) 2021, 2022 Blake Lee
+#
+# This file is part of nala
+#
+# nala is program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# nala is program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with nala.  If not, see <https://www.gnu.org/licenses/>.
+"""Pace, resume and copy the transfers of the package downloader."""
+from __future__ import annotations
+
+import asyncio
+import fcntl
+import os
+import shutil
+from asyncio import Condition, Semaphore
+from collections import deque
+from pathlib import Path
+from random import random
+from time import monotonic
+
+import apt_pkg
+from apt.package import Version
+from httpx import URL, Request, Response, TransportError
+
+from nala.mirrors import mirror_fault
+from nala.utils import dprint, unit_str
+
+# Packages at least this large are split into ranges fetched from several mirrors
+SEGMENT_THRESHOLD = apt_pkg.config.find_i('Nala::Download::Segment-Threshold', 50_000_000)
+SEGMENT_COUNT = apt_pkg.config.find_i('Nala::Download::Segments', 4)
+# Extended attributes holding the validators used to resume partial downloads
+ETAG_XATTR = 'user.nala.etag'
+LAST_MODIFIED_XATTR = 'user.nala.last-modified'
+HOST_XATTR = 'user.nala.host'
+# ioctl that shares the blocks of one file with another, on filesystems that can
+FICLONE = 0x40049409
+COPY_CHUNK = 64 * 1024 * 1024
+# Packages downloading at once grow from START_PARALLEL up to MAX_PARALLEL
+START_PARALLEL = 4
+MAX_PARALLEL = max(apt_pkg.config.find_i('Nala::Download::Max-Parallel', 32), 1)
+# Transfers allowed at once to a single mirror
+HOST_LIMIT = max(apt_pkg.config.find_i('Nala::Download::Host-Limit', 8), 1)
+# 'host' gives each mirror its own transfers, 'access' makes each method share one like apt
+QUEUE_MODE = apt_pkg.config.find('Acquire::Queue-Mode', 'host')
+# Extra attempts a package gets after a transfer fails, the same as apt
+RETRIES = max(apt_pkg.config.find_i('Acquire::Retries', 3), 0)
+# The wait between retry rounds doubles up to the maximum, and is jittered so retries don't
+# arrive together
+RETRY_DELAY = apt_pkg.config.find_b('Acquire::Retries::Delay', True)
+RETRY_DELAY_MAX = apt_pkg.config.find_i('Acquire::Retries::Delay::Maximum', 30)
+# Seconds between adjustments of the parallel download limit
+ADJUST_INTERVAL = 2
+# A transfer slower than STALL_RATE bytes per second over the last STALL_WINDOW seconds
+# is moved to another mirror. New transfers get STALL_GRACE seconds to get going first
+STALL_RATE = apt_pkg.config.find_i('Nala::Download::Stall-Rate', 1000)
+STALL_WINDOW = max(apt_pkg.config.find_i('Nala::Download::Stall-Window', 10), 1)
+STALL_GRACE = max(apt_pkg.config.find_i('Nala::Download::Stall-Grace', 15), STALL_WINDOW)
+
+class ConcurrencyController: # pylint: disable=too-many-instance-attributes
+	"""Adjust how many packages download at once from the measured throughput.
+
+	The limit grows by one while the extra transfers keep throughput up, and is
+	halved when mirrors start failing or timing out. Each mirror also has its own cap.
+	"""
+
+	def __init__(self) -> None:
+		"""Adjust how many packages download at once from the measured throughput."""
+		self.limit = min(START_PARALLEL, MAX_PARALLEL)
+		self.active = 0
+		self.data = 0
+		self.errors = 0
+		self.last_rate: float = 0
+		self.condition = Condition()
+		self.hosts: dict[str, Semaphore] = {}
+
+	async def __aenter__(self) -> None:
+		"""Wait for a free download slot."""
+		async with self.condition:
+			await self.condition.wait_for(lambda: self.active < self.limit)
+			self.active += 1
+
+	async def __aexit__(self, _type: object, _value: object, _traceback: object) -> None:
+		"""Give the download slot back."""
+		async with self.condition:
+			self.active -= 1
+			self.condition.notify_all()
+
+	def host(self, url: str) -> Semaphore:
+		"""Return the semaphore capping transfers to the host of url.
+
+		With Acquire::Queue-Mode access each method gets one, allowing a single transfer.
+		"""
+		if QUEUE_MODE == 'access':
+			key, limit = URL(url).scheme, 1
+		else:
+			key, limit = URL(url).host, HOST_LIMIT
+		if key not in self.hosts:
+			self.hosts[key] = Semaphore(limit)
+		return self.hosts[key]
+
+	def record(self, data: int) -> None:
+		"""Count downloaded bytes toward the throughput."""
+		self.data += data
+
+	def error(self, error: BaseException) -> None:
+		"""Count errors that suggest we're asking too much of the network or mirrors."""
+		if mirror_fault(error):
+			self.errors += 1
+
+	async def run(self) -> None:
+		"""Adjust the limit every ADJUST_INTERVAL seconds."""
+		while True:
+			await asyncio.sleep(ADJUST_INTERVAL)
+			await self.adjust()
+
+	async def adjust(self) -> None:
+		"""Adjust the limit from the throughput and errors since the last call."""
+		rate = self.data / ADJUST_INTERVAL
+		if self.errors:
+			self.limit = max(self.limit // 2, 1)
+		# Only grow if we're using every slot and throughput didn't suffer for it
+		elif self.active >= self.limit and rate >= self.last_rate * 0.9:
+			self.limit = min(self.limit + 1, MAX_PARALLEL)
+		elif rate < self.last_rate * 0.7:
+			self.limit = max(self.limit - 1, 1)
+		dprint(
+			f'Download rate: {unit_str(int(rate), 0)}/s, '
+			f'errors: {self.errors}, parallel limit: {self.limit}'
+		)
+		self.data = 0
+		self.errors = 0
+		self.last_rate = rate
+		async with self.condition:
+			self.condition.notify_all()
+
+class DownloadJob: # pylint: disable=too-many-instance-attributes
+	"""A package to download and the urls it can still be tried from."""
+
+	__slots__ = (
+		'candidate', 'urls', 'mirrors', 'segmented', 'position',
+		'retries', 'rounds', 'not_before', 'delta'
+	)
+
+	def __init__(self, candidate: Version,
+		urls: list[str], position: int = 0, delta: str | None = None) -> None:
+		"""A package to download and the urls it can still be tried from."""
+		self.candidate = candidate
+		self.urls = urls
+		# Url of a debdelta from the installed version, tried once before the urls
+		self.delta = delta
+		# Every url the job started with, for the retry rounds
+		self.mirrors = list(urls)
+		# Where the package falls in the install order, if we're pipelining
+		self.position = position
+		# Failed transfers that can still be tried again, set by Acquire::Retries
+		self.retries = RETRIES
+		# Retry rounds started so far, and when the current one may begin
+		self.rounds = 0
+		self.not_before: float = 0
+		# Large packages try a segmented download first
+		self.segmented = bool(urls) and SEGMENT_COUNT > 1 and candidate.size >= SEGMENT_THRESHOLD
+
+	def __lt__(self, other: DownloadJob) -> bool:
+		"""Order jobs by install position, then largest first so long transfers start early.
+
+		Jobs waiting to retry go behind everything that can start now.
+		"""
+		return bool(
+			(self.not_before, self.position, -self.candidate.size)
+			< (other.not_before, other.position, -other.candidate.size)
+		)
+
+	def __repr__(self) -> str:
+		"""Represent the download job as a string."""
+		return f'DownloadJob({self.name}, urls={len(self.urls)}, segmented={self.segmented})'
+
+	@property
+	def name(self) -> str:
+		"""Return the file name of the package."""
+		return Path(self.candidate.filename).name
+
+class Transfer:
+	"""A package transfer in flight, watched so a slow one can be hedged."""
+
+	__slots__ = ('job', 'url', 'start', 'offset', 'data', 'hedge')
+
+	def __init__(self, job: DownloadJob, url: str) -> None:
+		"""A package transfer in flight, watched so a slow one can be hedged."""
+		self.job = job
+		self.url = url
+		# Set once the response starts streaming, waiting for a slot isn't transfer time
+		self.start: float = 0
+		# Bytes resumed from a partial file, and bytes written including those
+		self.offset = 0
+		self.data = 0
+		# Set when the transfer should be raced against another mirror
+		self.hedge = asyncio.Event()
+
+	def rate(self) -> float:
+		"""Return the bytes per second streamed so far."""
+		if not self.start:
+			return 0
+		elapsed = monotonic() - self.start
+		return (self.data - self.offset) / elapsed if elapsed else 0
+
+	def eta(self) -> float:
+		"""Return the estimated seconds until the transfer finishes."""
+		if not (rate := self.rate()):
+			return float('inf')
+		return (self.job.candidate.size - self.data) / rate
+
+class ConnectionStats:
+	"""Count how many requests opened a new connection and how many reused one."""
+
+	def __init__(self) -> None:
+		"""Count how many requests opened a new connection and how many reused one."""
+		self.requests = 0
+		self.opened = 0
+		self.handshakes = 0
+		self.http2 = 0
+
+	def __repr__(self) -> str:
+		"""Represent the connection stats as a string."""
+		return (
+			f'ConnectionStats(requests={self.requests}, opened={self.opened}, '
+			f'reused={self.reused()}, tls_handshakes={self.handshakes}, http2={self.http2})'
+		)
+
+	def reused(self) -> int:
+		"""Return the requests that went over a connection that was already open."""
+		return max(self.requests - self.opened, 0)
+
+	async def request(self, request: Request) -> None:
+		"""Count a request and trace it through the connection pool."""
+		self.requests += 1
+		request.extensions['trace'] = self.trace
+
+	async def response(self, response: Response) -> None:
+		"""Count responses that were multiplexed over HTTP/2."""
+		if response.http_version == 'HTTP/2':
+			self.http2 += 1
+
+	async def trace(self, event: str, _info: dict[str, object]) -> None:
+		"""Count the connections and TLS handshakes httpcore reports."""
+		if event == 'connection.connect_tcp.complete':
+			self.opened += 1
+		elif event == 'connection.start_tls.complete':
+			self.handshakes += 1
+
+class TransferStalled(TransportError):
+	"""A transfer fell below the minimum throughput."""
+
+class StallWatch: # pylint: disable=too-few-public-methods
+	"""Measure throughput over a sliding window to catch stalled transfers."""
+
+	__slots__ = ('floor', 'start', 'samples', 'window_data')
+
+	def __init__(self, floor: int = STALL_RATE) -> None:
+		"""Measure throughput over a sliding window to catch stalled transfers."""
+		self.floor = floor
+		self.start = monotonic()
+		self.samples: deque[tuple[float, int]] = deque()
+		self.window_data = 0
+
+	def update(self, url: str, len_data: int) -> None:
+		"""Count len_data bytes, raising TransferStalled if the window is too slow.
+
+		A transfer that goes completely silent is caught by the read timeout instead.
+		"""
+		now = monotonic()
+		self.samples.append((now, len_data))
+		self.window_data += len_data
+		while self.samples[0][0] < now - STALL_WINDOW:
+			self.window_data -= self.samples.popleft()[1]
+		if self.floor <= 0 or now - self.start < STALL_GRACE:
+			return
+		if (rate := self.window_data / STALL_WINDOW) < self.floor:
+			raise TransferStalled(
+				f'{url} stalled at {unit_str(int(rate), 1)}/s'
+			)
+
+class TokenBucket: # pylint: disable=too-few-public-methods
+	"""Limit the bytes per second of every transfer that shares the bucket."""
+
+	def __init__(self, rate: int) -> None:
+		"""Limit the bytes per second of every transfer that shares the bucket."""
+		self.rate = rate
+		self.tokens = float(rate)
+		self.updated = monotonic()
+		self.lock = asyncio.Lock()
+
+	async def take(self, amount: int) -> None:
+		"""Wait until amount bytes fit under the rate.
+
+		Transfers are let through in the order they asked so each gets its share.
+		"""
+		async with self.lock:
+			now = monotonic()
+			self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.rate)
+			self.updated = now
+			self.tokens -= amount
+			if self.tokens < 0:
+				await asyncio.sleep(-self.tokens / self.rate)
+
+class BandwidthLimiter:
+	"""Apply apt's Acquire::http::Dl-Limit overall, and to any host it is set for."""
+
+	def __init__(self) -> None:
+		"""Apply apt's Acquire::http::Dl-Limit overall, and to any host it is set for."""
+		# apt counts the limit in kilobytes
+		rate = apt_pkg.config.find_i('Acquire::http::Dl-Limit', 0) * 1024
+		self.total = TokenBucket(rate) if rate > 0 else None
+		self.hosts: dict[str, TokenBucket | None] = {}
+
+	def buckets(self, url: str) -> list[TokenBucket]:
+		"""Return the buckets a transfer from url draws from."""
+		host = str(URL(url).host)
+		if host not in self.hosts:
+			key = f'Acquire::http::Dl-Limit::{host}'
+			rate = apt_pkg.config.find_i(key, 0) * 1024
+			self.hosts[host] = TokenBucket(rate) if rate > 0 else None
+		return [bucket for bucket in (self.total, self.hosts[host]) if bucket]
+
+	def limited(self, url: str) -> bool:
+		"""Return True if transfers from url are held to a rate."""
+		return bool(self.buckets(url))
+
+	async def take(self, url: str, amount: int) -> None:
+		"""Wait until amount bytes from url fit under its limits."""
+		for bucket in self.buckets(url):
+			await bucket.take(amount)
+
+def copy_local(source: Path, dest: Path, link: bool) -> None:
+	"""Put a copy of source at dest, as cheaply as the filesystems allow.
+
+	If link is set a hardlink is tried first, then a reflink, and if neither
+	works the data is copied inside the kernel with copy_file_range.
+	"""
+	dest.unlink(missing_ok=True)
+	if link:
+		try:
+			os.link(source, dest)
+			return
+		# Different filesystems, or hardlinks aren't allowed
+		except OSError:
+			pass
+	with open(source, 'rb') as src, open(dest, 'wb') as dst:
+		try:
+			fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+			return
+		except OSError:
+			pass
+		try:
+			while os.copy_file_range(src.fileno(), dst.fileno(), COPY_CHUNK):
+				pass
+			return
+		# Older kernels can't copy_file_range between filesystems
+		except OSError:
+			src.seek(0)
+			dst.seek(0)
+			dst.truncate()
+	# shutil uses sendfile where it can
+	shutil.copyfile(source, dest)
+
+def resume_offset(dest: Path, size: int) -> int:
+	"""Return the byte offset a partial download can be resumed from.
+
+	A file that is already full size can't be told apart from a
+	preallocated segmented download, so it is removed and started over.
+	"""
+	try:
+		offset = dest.stat().st_size
+	except FileNotFoundError:
+		return 0
+	if offset >= size:
+		dprint(f'Removing full size partial file {dest}')
+		dest.unlink(missing_ok=True)
+		return 0
+	return offset
+
+def resume_headers(dest: Path, offset: int, url: str) -> dict[str, str]:
+	"""Return the Range and If-Range headers to resume a partial download.
+
+	A partial from another mirror is resumed too, its ETag means nothing here so only
+	Last-Modified is used. The digest check catches a mismatch either way.
+	"""
+	if not offset:
+		return {}
+	headers = {'Range': f'bytes={offset}-'}
+	attrs: tuple[str, ...] = (ETAG_XATTR, LAST_MODIFIED_XATTR)
+	try:
+		if os.getxattr(dest, HOST_XATTR).decode() != URL(url).host:
+			attrs = (LAST_MODIFIED_XATTR,)
+	except OSError:
+		pass
+	# If-Range makes the server send the whole file if it has changed since
+	for attr in attrs:
+		try:
+			validator = os.getxattr(dest, attr).decode()
+		except OSError:
+			continue
+		# Weak validators are not allowed in If-Range
+		if not validator.startswith('W/'):
+			headers['If-Range'] = validator
+			break
+	return headers
+
+def save_validators(dest: Path, response: Response) -> None:
+	"""Store the validators of a new download so it can be resumed later."""
+	headers = {
+		'etag': response.headers.get('etag'),
+		'last-modified': response.headers.get('last-modified'),
+		'host': response.url.host,
+	}
+	for header, attr in (
+		('etag', ETAG_XATTR), ('last-modified', LAST_MODIFIED_XATTR), ('host', HOST_XATTR)
+	):
+		try:
+			if value := headers[header]:
+				os.setxattr(dest, attr, value.encode())
+			else:
+				os.removexattr(dest, attr)
+		# The filesystem may not support extended attributes, or there was nothing to remove.
+		except OSError:
+			pass
+
+def valid_content_range(
+	response: Response, offset: int, size: int, end: int | None = None) -> bool:
+	"""Check the server is sending the range of the file we expect.
+
+	Without an end the range runs to the end of the file, as it does for a resume.
+	"""
+	end = size - 1 if end is None else end
+	return response.headers.get('content-range') == f'bytes {offset}-{end}/{size}'
+
+def retry_delay(rounds: int) -> float:
+	"""Return the seconds to wait before retry round number rounds.
+
+	The delay doubles each round, and a random half of it is taken off.
+	"""
+	if not RETRY_DELAY:
+		return 0
+	delay = min(2 ** rounds, RETRY_DELAY_MAX)
+	return delay / 2 + random() * delay / 2
+
+def split_ranges(size: int, count: int) -> list[tuple[int, int]]:
+	"""Split size bytes into count inclusive byte ranges for Range requests."""
+	step = -(-size // count)
+	return [
+		(start, min(start + step, size) - 1) for start in range(0, size, step)
+	]
@@ -34,16 +34,24 @@ import tty
 from datetime import datetime
 from pathlib import Path
 from shutil import get_terminal_size
+from threading import Lock
 from types import FrameType
+from typing import TYPE_CHECKING
 
 import jsbeautifier
 from apt.package import Package, Version
 
-from nala.constants import (COLOR_CODES, ERROR_PREFIX,
-				HANDLER, JSON_OPTIONS, NALA_DEBUGLOG)
+from nala.constants import (ARCHIVE_DIR, ARCHIVE_INDEX, COLOR_CODES,
+				ERROR_PREFIX, HANDLER, JSON_OPTIONS, NALA_DEBUGLOG)
 from nala.options import arguments
 from nala.rich import Table, console
 
+if TYPE_CHECKING:
+	from hashlib import _Hash
+
+# Bytes read at a time when hashing archives
+HASH_BUFFER = 1024 * 1024
+
 
 class Terminal:
 	"""Represent the user terminal."""
@@ -154,6 +162,63 @@ class Terminal:
 		"""Return True if we're super user and False if we're not."""
 		return os.geteuid() == 0
 
+class ArchiveIndex:
+	"""Digests of archives we've verified, keyed by path and checked against stat."""
+
+	def __init__(self) -> None:
+		"""Digests of archives we've verified, keyed by path and checked against stat."""
+		self.entries: dict[str, list[int | str]] | None = None
+		self.changed = False
+		# Archives are checked from executor threads while the downloads run
+		self.lock = Lock()
+
+	def load(self) -> dict[str, list[int | str]]:
+		"""Read the index the first time it's needed, the lock must be held."""
+		if self.entries is None:
+			try:
+				entries = json.loads(ARCHIVE_INDEX.read_text(encoding='utf-8'))
+				self.entries = entries if isinstance(entries, dict) else {}
+			except (OSError, ValueError):
+				# A missing or broken index only costs us a rehash
+				self.entries = {}
+		return self.entries
+
+	def verified(self, path: Path, stat: os.stat_result, hash_type: str, hash_value: str) -> bool:
+		"""Return True if path was verified as hash_value and hasn't changed since."""
+		with self.lock:
+			entry = self.load().get(str(path))
+		return entry == [stat.st_size, stat.st_mtime_ns, stat.st_ino, hash_type, hash_value]
+
+	def add(self, path: Path,
+		hash_type: str, hash_value: str, stat: os.stat_result | None = None) -> None:
+		"""Record that path matches hash_value."""
+		try:
+			stat = stat or path.stat()
+		except OSError:
+			return
+		with self.lock:
+			self.load()[str(path)] = [
+				stat.st_size, stat.st_mtime_ns, stat.st_ino, hash_type, hash_value
+			]
+			self.changed = True
+
+	def save(self) -> None:
+		"""Write the index, dropping archives that are gone."""
+		with self.lock:
+			if not self.changed or self.entries is None:
+				return
+			entries = dict(self.entries)
+			self.changed = False
+		entries = {path: entry for path, entry in entries.items() if Path(path).exists()}
+		tmp = ARCHIVE_INDEX.with_suffix('.tmp')
+		try:
+			tmp.write_text(json.dumps(entries), encoding='utf-8')
+			tmp.replace(ARCHIVE_INDEX)
+		except OSError as err:
+			dprint(f"Failed to write {ARCHIVE_INDEX}: {err}")
+			with self.lock:
+				self.changed = True
+
 class DelayedKeyboardInterrupt:
 	"""Context manager to delay KeyboardInterrupt.
 
@@ -182,6 +247,7 @@ class DelayedKeyboardInterrupt:
 			self.old_handler(*self.signal_received)
 
 term = Terminal()
+archive_index = ArchiveIndex()
 
 def color(text: str, text_color: str = 'WHITE') -> str:
 	"""Return bold text in the color of your choice."""
@@ -227,25 +293,30 @@ def check_pkg(directory: Path, candidate: Package | Version) -> bool:
 	if isinstance(candidate, Package):
 		candidate = pkg_candidate(candidate)
 	path = directory / get_pkg_name(candidate)
-	if not path.exists() or path.stat().st_size != candidate.size:
+	try:
+		stat = path.stat()
+	except FileNotFoundError:
+		return False
+	if stat.st_size != candidate.size:
 		return False
 	hash_type, hash_value = get_hash(candidate)
+	if archive_index.verified(path, stat, hash_type, hash_value):
+		dprint(f"{path} is unchanged since it was verified")
+		return True
 	try:
-		return check_hash(path, hash_type, hash_value)
+		if not check_hash(path, hash_type, hash_value):
+			return False
 	except OSError as err:
 		print("Failed to check hash", err)
 		return False
+	# Partials are renamed into the archive, only archives are worth remembering
+	if directory == ARCHIVE_DIR:
+		archive_index.add(path, hash_type, hash_value, stat)
+	return True
 
 def check_hash(path: Path, hash_type: str, hash_value: str) -> bool:
 	"""Check hash value."""
-	hash_fun = hashlib.new(hash_type)
-	with path.open('rb') as file:
-		while True:
-			data = file.read(4096)
-			if not data:
-				break
-			hash_fun.update(data)
-	local_hash = hash_fun.hexdigest()
+	local_hash = hash_file(path, hashlib.new(hash_type)).hexdigest()
 	debugger = (
 		str(path),
 		f"Candidate Hash: {hash_type} {hash_value}",
@@ -255,6 +326,25 @@ def check_hash(path: Path, hash_type: str, hash_value: str) -> bool:
 	dprint(debugger)
 	return local_hash == hash_value
 
+def check_digest(candidate: Version, digest: str) -> bool:
+	"""Check the digest computed while downloading against the candidate."""
+	hash_type, hash_value = get_hash(candidate)
+	dprint((
+		get_pkg_name(candidate),
+		f"Candidate Hash: {hash_type} {hash_value}",
+		f"Local Hash: {digest}",
+		f"Hash Success: {digest == hash_value}"
+	))
+	return digest == hash_value
+
+def hash_file(path: Path, hash_fun: _Hash) -> _Hash:
+	"""Update hash_fun with the contents of path and return it."""
+	with path.open('rb', buffering=0) as file:
+		# hashlib releases the GIL on large updates, so this can run in threads
+		while data := file.read(HASH_BUFFER):
+			hash_fun.update(data)
+	return hash_fun
+
 def get_hash(version: Version) -> tuple[str, str]:
 	"""Get the correct hash value."""
 	if version.sha256:
@@ -46,10 +46,12 @@ setup(
 		'pexpect',
 		'jsbeautifier',
 		'pyyaml',
-		'pythonping==1.1.1',
 		'rich==11.1.0',
 		'httpx==0.22.0',
 	],
+	extras_require={
+		'http2': ['httpx[http2]==0.22.0'],
+	},
 
 	entry_points={  # Optional
 		'console_scripts': [